@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+'''
+ATRWeb Mock Server
+
+A local stand-in for ATRWeb so that TimeCardAPI can be tested and measured
+without a live host.  It serves the login pages, a DayInfo.asp page with a
+synthetic catalogue of whatever size is asked for, and operate.asp, which
+remembers the entries that were posted to it.  Those entries are listed on
+the DayInfo.asp page for their day and employee in a TimingArray, the same
+way reconcile expects to find them on ATRWeb.  Latency and errors can be
+injected to see how TimeCard copes with a slow or flaky server.  Usage:
+
+  atrmock.py [OPTIONS]
+
+   -p (--port) [PORT]         The port to listen on.  (Default: 8765)
+   -d (--departments) [NUM]   The number of departments.  (Default: 50)
+   -P (--projects) [NUM]      The number of projects.  (Default: 100)
+   -t (--tasks) [NUM]         The number of tasks.  (Default: 1000)
+   -l (--latency) [MS]        Delay added to every response.  (Default: 0)
+   -j (--jitter) [MS]         Random extra delay of up to this much.
+   -e (--errors) [RATE]       The fraction (0-1) of DayInfo.asp and
+                              operate.asp requests that fail with a 500.
+   -x (--expire) [SECONDS]    Sessions expire after this long.  (Default: 0,
+                              sessions never expire)
+   -w (--password) [PASSWORD] Only accept logins with this password.
+
+Then point the host in config.ini at 127.0.0.1:PORT with ssl = no.
+'''
+
+import time
+import random
+import getopt
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+def dayinfo_page(projects, tasks, departments=50):
+  '''
+  dayinfo_page(projects, tasks, departments=50)
+  Builds a synthetic DayInfo.asp page with the given number of projects and
+  tasks.  The tasks are spread evenly across all of the projects.
+  '''
+  names = ','.join(['"Project %d"' % i for i in range(projects)])
+  ids   = ','.join(['"%d"' % (i + 1) for i in range(projects)])
+  tlist = ','.join(["new Array(%d,'Task %d',%d)" % (i % projects + 1, i, i + 1)
+                    for i in range(tasks)])
+  deps  = ''.join(['<option value="%d">Department %d</option>' % (i, i)
+                   for i in range(1, departments + 1)])
+  return '\r\n'.join([
+    '<html><head><title>DayInfo</title>',
+    '<script language="javascript">',
+    'Np=new Array(%s);' % names,
+    'Kp=new Array(%s);' % ids,
+    'TaskArray = new Array(%s);' % tlist,
+    '</script></head><body><form name="frm" action="operate.asp">',
+    '<select name="ddl_abbr"><option value="">--</option>%s</select>' % deps,
+    '</form></body></html>',
+  ])
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  '''
+  Handles the ATRWeb requests for the MockATR that owns the server.
+  '''
+  protocol_version = 'HTTP/1.1'
+  wbufsize         = -1
+  
+  def setup(self):
+    '''
+    Buffers the responses and turns off Nagle's algorithm.  Otherwise the
+    small writes at the end of each response wait on the client's delayed ACK
+    and add 40ms to every keep-alive request.
+    '''
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  
+  def log_message(self, *args):
+    pass
+  
+  def _send(self, status, body, headers={}):
+    '''
+    Private Function:  Sends the response with a Content-Length so that the
+    connection can be kept alive.
+    '''
+    self.send_response(status)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', len(body))
+    self.end_headers()
+    self.wfile.write(body)
+  
+  def _handle(self):
+    '''
+    Private Function:  Works out which page was asked for and responds.
+    '''
+    mock    = self.server.mock
+    length  = int(self.headers.get('content-length') or 0)
+    body    = self.rfile.read(length) if length > 0 else ''
+    cookie  = (self.headers.get('cookie') or '').split(';')[0].strip()
+    path    = self.path.split('?')[0].lower()
+    mock.delay()
+
+    if path == '/atrweb/':
+      return self._send(200, '<form action="Default.asp?Action=Login">',
+                        {'Set-Cookie': '%s; path=/' % mock.new_session()})
+    if path == '/atrweb/default.asp' and 'Action=Login' in self.path:
+      mock.count('login')
+      if not mock.login(cookie, body):
+        return self._send(302, 'Object moved',
+                          {'Location': '/atrweb/Default.asp'})
+      return self._send(302, 'Object moved',
+                        {'Location': '/atrweb/Main.asp'})
+    if not mock.valid(cookie):
+      mock.count('expired')
+      return self._send(302, 'Object moved',
+                        {'Location': '/atrweb/Default.asp'})
+    if path in ('/atrweb/dayinfo.asp', '/atrweb/operate.asp') and\
+       mock.fail():
+      mock.count('errors')
+      return self._send(500, 'Internal Server Error')
+    if path == '/atrweb/dayinfo.asp':
+      import cgi
+      mock.count('dayinfo')
+      query = dict([(k, v[0]) for k, v in 
+                    cgi.parse_qs(self.path.partition('?')[2]).items()])
+      return self._send(200, mock.page(query.get('adtmDate'), 
+                                       query.get('sel_names')))
+    if path == '/atrweb/operate.asp':
+      mock.count('operate')
+      mock.record(body)
+      return self._send(200, '<html><body>Saved</body></html>')
+    return self._send(404, 'Not Found')
+  
+  do_GET  = _handle
+  do_POST = _handle
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads      = True
+  allow_reuse_address = True
+
+
+class MockATR(object):
+  '''
+  The mock ATRWeb server.  The server runs in a background thread between
+  start() and stop(), and stats keeps a count of each kind of request.
+  '''
+  def __init__(self, port=0, projects=100, tasks=1000, departments=50,
+               latency=0, jitter=0, errors=0, expire=0, password=None):
+    '''
+    __init__(port=0, projects=100, tasks=1000, departments=50, latency=0,
+             jitter=0, errors=0, expire=0, password=None)
+    Sets up the server.  A port of 0 picks any free port.  latency and jitter
+    are in milliseconds, errors is the fraction of requests that fail, and
+    expire is how many seconds a session lasts (0 for forever).  If a
+    password is given, logins with any other password are bounced back to
+    the login page.
+    '''
+    self.password     = password
+    self.latency      = latency
+    self.jitter       = jitter
+    self.errors       = errors
+    self.expire       = expire
+    self.entries      = []
+    self.stats        = {}
+    self.sessions     = {}
+    self.lock         = threading.Lock()
+    self.random       = random.Random(0)
+    self.catalogue(projects, tasks, departments)
+    self.server       = Server(('127.0.0.1', port), Handler)
+    self.server.mock  = self
+    self.port         = self.server.server_address[1]
+    self.host         = '127.0.0.1:%d' % self.port
+    self.thread       = None
+  
+  def catalogue(self, projects, tasks, departments=50):
+    '''
+    catalogue(projects, tasks, departments=50)
+    Changes the size of the catalogue that DayInfo.asp serves.
+    '''
+    self._page = dayinfo_page(projects, tasks, departments)
+  
+  def page(self, date=None, employee=None):
+    '''
+    page(date=None, employee=None)
+    Returns the DayInfo.asp page, with the entries that have been posted for
+    the employee on the date (DD/MM/YYYY) in the TimingArray.
+    '''
+    def quote(value):
+      return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+    with self.lock:
+      forms = [(idx, form) for idx, form in enumerate(self.entries)
+               if form.get('int_employee_id') == employee and
+                  self._date(form.get('dtm_date')) == date]
+    timings = ','.join(["new Array(%d,%s,%s,%s,%s,%s,%s,%s,%d)" % (
+                          idx + 1, quote(form.get('dtm_from', '')),
+                          quote(form.get('dtm_to', '')),
+                          form.get('ddl_abbr') or 0, 
+                          form.get('ddl_project') or 0,
+                          form.get('tasks') or 0, 
+                          quote(form.get('txt_description', '')),
+                          quote(form.get('txt_notes', '')),
+                          form.get('is_billable') == 'True')
+                        for idx, form in forms])
+    return self._page.replace('</script>', 
+                              'TimingArray = new Array(%s);\r\n</script>' %
+                              timings, 1)
+  
+  def _date(self, value):
+    '''
+    Private Function:  Turns an operate.asp date (MM/DD/YYYY) into the
+    DayInfo.asp form (DD/MM/YYYY).
+    '''
+    parts = (value or '').split('/')
+    if len(parts) != 3:
+      return None
+    return '%s/%s/%s' % (parts[1], parts[0], parts[2])
+  
+  def delay(self):
+    '''
+    Sleeps for the configured latency plus jitter.
+    '''
+    wait = self.latency + self.random.random() * self.jitter
+    if wait > 0:
+      time.sleep(wait / 1000.0)
+  
+  def fail(self):
+    '''
+    Returns True if this request should fail.
+    '''
+    with self.lock:
+      return self.random.random() < self.errors
+  
+  def count(self, name):
+    '''
+    Adds one to the count of the kind of request.
+    '''
+    with self.lock:
+      self.stats[name] = self.stats.get(name, 0) + 1
+  
+  def new_session(self):
+    '''
+    Returns a new session cookie.  It isn't valid until it has logged in.
+    '''
+    with self.lock:
+      return 'ASPSESSIONIDMOCK=%08X' % self.random.randint(0, 0x7fffffff)
+  
+  def login(self, cookie, body=''):
+    '''
+    login(cookie, body='')
+    Marks the session cookie as logged in and returns True, unless the
+    password in the posted login form is the wrong one.
+    '''
+    import cgi
+    form = dict([(k, v[0]) for k, v in cgi.parse_qs(body).items()])
+    if self.password is not None and form.get('Password') != self.password:
+      return False
+    with self.lock:
+      self.sessions[cookie] = time.time()
+    return True
+  
+  def valid(self, cookie):
+    '''
+    Returns True if the session cookie is logged in and hasn't expired.
+    '''
+    with self.lock:
+      started = self.sessions.get(cookie)
+    if started is None:
+      return False
+    return self.expire <= 0 or time.time() - started < self.expire
+  
+  def expire_sessions(self):
+    '''
+    Expires every session right away.
+    '''
+    with self.lock:
+      self.sessions.clear()
+  
+  def record(self, body):
+    '''
+    Keeps the form that was posted to operate.asp.
+    '''
+    import cgi
+    form = dict([(k, v[0]) for k, v in cgi.parse_qs(body).items()])
+    with self.lock:
+      self.entries.append(form)
+  
+  def reset(self):
+    '''
+    Clears the stats and the posted entries.
+    '''
+    with self.lock:
+      self.stats    = {}
+      self.entries  = []
+  
+  def start(self):
+    '''
+    Starts serving in a background thread.
+    '''
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+  
+  def stop(self):
+    '''
+    Stops serving and closes the socket.
+    '''
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+
+if __name__ == '__main__':
+  import sys
+  options = {'port': 8765}
+  opts, args  = getopt.getopt(sys.argv[1:], 'p:d:P:t:l:j:e:x:w:',
+                              ['port=', 'departments=', 'projects=', 'tasks=',
+                               'latency=', 'jitter=', 'errors=', 'expire=',
+                               'password='])
+  for opt, val in opts:
+    if opt in ('-p', '--port'):
+      options['port'] = int(val)
+    if opt in ('-d', '--departments'):
+      options['departments'] = int(val)
+    if opt in ('-P', '--projects'):
+      options['projects'] = int(val)
+    if opt in ('-t', '--tasks'):
+      options['tasks'] = int(val)
+    if opt in ('-l', '--latency'):
+      options['latency'] = float(val)
+    if opt in ('-j', '--jitter'):
+      options['jitter'] = float(val)
+    if opt in ('-e', '--errors'):
+      options['errors'] = float(val)
+    if opt in ('-x', '--expire'):
+      options['expire'] = float(val)
+    if opt in ('-w', '--password'):
+      options['password'] = val
+  mock = MockATR(**options)
+  print 'Mock ATRWeb listening on %s' % mock.host
+  try:
+    mock.server.serve_forever()
+  except KeyboardInterrupt:
+    pass
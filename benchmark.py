@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+'''
+TimeCard Benchmarks
+
+Runs a set of timing benchmarks against synthetic data so that we have some
+actual numbers to look at when something is slow.  Usage:
+
+  benchmark.py [catalogue] [startup] [api] [update] [push] [reconcile]
+
+The api, update, push, and reconcile benchmarks talk to a local mock ATRWeb
+server (see atrmock.py), so they don't need a live host.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import timecard
+from atrmock import MockATR, dayinfo_page
+
+
+def bench_catalogue():
+  '''
+  Times the DayInfo.asp scan and catalogue reconstruction at increasing
+  catalogue sizes.  If the reconstruction is linear, the time per task should
+  stay roughly flat as the catalogue grows.
+  '''
+  print '%-10s %-10s %-12s %-10s %-10s %-10s' %\
+        ('PROJECTS', 'TASKS', 'BYTES', 'SCAN', 'BUILD', 'US/TASK')
+  for projects, tasks in [(1000, 10000), (2500, 25000),
+                          (5000, 50000), (10000, 100000)]:
+    page    = dayinfo_page(projects, tasks)
+    started = time.time()
+    parser  = timecard.DayInfoParser()
+    for idx in range(0, len(page), 16384):
+      parser.feed(page[idx:idx + 16384])
+    scanned = time.time()
+    db      = parser.catalogue()
+    built   = time.time()
+    assert len(db['projects']) == projects
+    assert sum([len(p['tasks']) for p in db['projects'].values()]) == tasks
+    print '%-10d %-10d %-12d %-10.3f %-10.3f %-10.2f' %\
+          (projects, tasks, len(page), scanned - started, built - scanned,
+           (built - started) / tasks * 1000000)
+
+
+def bench_startup(runs=20):
+  '''
+  Times one-shot invocations of timecard.py, which is what every script that
+  calls "timecard.py show" pays.  A scratch copy of timecard.py is used so
+  that the real config and database are left alone.
+  '''
+  path    = tempfile.mkdtemp()
+  script  = os.path.join(path, 'timecard.py')
+  shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                           'timecard.py'), script)
+  open(os.path.join(path, 'config.ini'), 'w').write(timecard.default_config)
+  null    = open(os.devnull, 'w')
+  
+  def run(*args):
+    started = time.time()
+    subprocess.call([sys.executable] + list(args), stdout=null, stderr=null,
+                    cwd=path)
+    return time.time() - started
+  
+  try:
+    print '%-28s %-10s %-10s %-10s' % ('COMMAND', 'MIN', 'MEAN', 'MAX')
+    print '%-28s %-10.3f' % ('show (new database)', run(script, 'show'))
+    for command in [['-c', 'pass'], ['-c', 'import timecard'], ['show'], 
+                    ['list', '-d'], ['help']]:
+      if command[0] == '-c':
+        args  = command
+        name  = 'python %s' % ' '.join(command)
+      else:
+        args  = [script] + command
+        name  = ' '.join(command)
+      times = [run(*args) for i in range(runs)]
+      print '%-28s %-10.3f %-10.3f %-10.3f' %\
+            (name, min(times), sum(times) / len(times), max(times))
+  finally:
+    null.close()
+    shutil.rmtree(path)
+
+
+def scratch(host):
+  '''
+  scratch(host)
+  Creates a scratch directory with a config file that points at the host, so
+  that a TimeCardCLI can be run against the mock server without touching the
+  real config and database.  Returns the path.
+  '''
+  path    = tempfile.mkdtemp()
+  config  = timecard.default_config.replace('infrastructuretime', host)\
+                                   .replace('ssl = yes', 'ssl = no')
+  open(os.path.join(path, 'config.ini'), 'w').write(config)
+  return path
+
+
+def quietly(func, *args):
+  '''
+  quietly(func, *args)
+  Runs the function with stdout thrown away and returns how long it took.
+  '''
+  null        = open(os.devnull, 'w')
+  stdout      = sys.stdout
+  sys.stdout  = null
+  try:
+    started = time.time()
+    func(*args)
+    return time.time() - started
+  finally:
+    sys.stdout = stdout
+    null.close()
+
+
+def bench_api(runs=10):
+  '''
+  Times TimeCardAPI.login and pull_database against the mock server at
+  increasing catalogue sizes and server latencies.
+  '''
+  print '%-10s %-10s %-8s %-22s %-22s' %\
+        ('PROJECTS', 'TASKS', 'LATENCY', 'LOGIN MIN/MEAN', 'PULL MIN/MEAN')
+  for latency in (0, 20):
+    for projects, tasks in [(100, 1000), (1000, 10000), (5000, 50000)]:
+      mock  = MockATR(projects=projects, tasks=tasks, latency=latency).start()
+      api   = timecard.TimeCardAPI('bench', 'bench', mock.host, 0, False)
+      try:
+        logins  = []
+        pulls   = []
+        for idx in range(runs):
+          started = time.time()
+          api.login()
+          logins.append(time.time() - started)
+          started = time.time()
+          db      = api.pull_database()
+          pulls.append(time.time() - started)
+          assert len(db['projects']) == projects
+        print '%-10d %-10d %-8d %-10.4f %-11.4f %-10.4f %-11.4f' %\
+              (projects, tasks, latency, min(logins), 
+               sum(logins) / len(logins), min(pulls), sum(pulls) / len(pulls))
+      finally:
+        api.pool.close()
+        mock.stop()
+
+
+def counts(cli):
+  '''
+  counts(cli)
+  Returns the number of projects and tasks in the CLI's database.
+  '''
+  conn  = cli.engine.connect()
+  try:
+    return tuple([conn.execute(timecard.select([timecard.func.count()])\
+                               .select_from(table)).scalar()
+                  for table in (timecard.Project.__table__, 
+                                timecard.Task.__table__)])
+  finally:
+    conn.close()
+
+
+def bench_update():
+  '''
+  Times the update command against the mock server: the first update into an
+  empty database, an update where nothing has changed, and an update after a
+  tenth of the projects have gained a task.  The project and task counts are
+  checked after every update, since a fast update that loses rows is no use.
+  '''
+  print '%-10s %-10s %-10s %-10s %-10s' %\
+        ('PROJECTS', 'TASKS', 'FIRST', 'UNCHANGED', 'CHANGED')
+  for projects, tasks in [(100, 1000), (1000, 10000), (5000, 50000)]:
+    mock  = MockATR(projects=projects, tasks=tasks).start()
+    path  = scratch(mock.host)
+    try:
+      cli       = timecard.TimeCardCLI(path)
+      first     = quietly(cli.do_update, '')
+      assert counts(cli) == (projects, tasks)
+      unchanged = quietly(cli.do_update, '')
+      assert counts(cli) == (projects, tasks)
+      mock.catalogue(projects, tasks + projects / 10)
+      changed   = quietly(cli.do_update, '')
+      assert counts(cli) == (projects, tasks + projects / 10)
+      print '%-10d %-10d %-10.3f %-10.3f %-10.3f' %\
+            (projects, tasks, first, unchanged, changed)
+    finally:
+      mock.stop()
+      shutil.rmtree(path)
+
+
+def bench_push():
+  '''
+  Times the push command against the mock server with different numbers of
+  entries, server latencies, and concurrency.  A run with errors injected
+  shows the cost of failures, and every run is followed by a second push that
+  should find nothing left to send.
+  '''
+  print '%-8s %-8s %-8s %-8s %-10s %-10s %-8s %-10s' %\
+        ('ENTRIES', 'LATENCY', 'ERRORS', 'WORKERS', 'SECONDS', 'ENTRIES/S',
+         'FAILED', 'REPUSH')
+  date  = '2012-05-01'
+  for entries, latency, errors, workers in [(100, 0, 0, 1), (100, 0, 0, 4),
+                                            (100, 20, 0, 1), (100, 20, 0, 4),
+                                            (400, 20, 0, 8), 
+                                            (100, 20, 0.1, 4)]:
+    mock  = MockATR(latency=latency, errors=errors).start()
+    path  = scratch(mock.host)
+    try:
+      cli   = timecard.TimeCardCLI(path)
+      quietly(cli.do_update, '')
+      conn  = cli.engine.connect()
+      conn.execute(timecard.TimeEntry.__table__.insert(), [{
+        'date':           timecard.datetime.date(2012, 5, 1),
+        'start_time':     timecard.datetime.time(idx / 60 % 24, idx % 60),
+        'end_time':       timecard.datetime.time(idx / 60 % 24, idx % 60),
+        'billable':       False,
+        'department_id':  1,
+        'project_id':     1,
+        'task_id':        1,
+        'description':    'Benchmark entry %d' % idx,
+        'notes':          '',
+      } for idx in range(entries)])
+      conn.close()
+      mock.reset()
+      seconds = quietly(cli.do_push, '-d %s -c %d' % (date, workers))
+      failed  = entries - mock.stats.get('operate', 0)
+      repush  = quietly(cli.do_push, '-d %s -c %d' % (date, workers))
+      print '%-8d %-8d %-8.2f %-8d %-10.3f %-10.1f %-8d %-10.3f' %\
+            (entries, latency, errors, workers, seconds, entries / seconds,
+             failed, repush)
+    finally:
+      mock.stop()
+      shutil.rmtree(path)
+
+
+def bench_reconcile(days=31):
+  '''
+  Times the reconcile command over a month of entries against the mock
+  server at different server latencies and numbers of concurrent page
+  fetches.
+  '''
+  print '%-8s %-8s %-8s %-10s %-10s' %\
+        ('DAYS', 'LATENCY', 'WORKERS', 'SECONDS', 'DAYS/S')
+  first = timecard.datetime.date(2012, 5, 1)
+  last  = first + timecard.datetime.timedelta(days=days - 1)
+  for latency in (0, 20, 100):
+    mock  = MockATR(latency=latency).start()
+    path  = scratch(mock.host)
+    try:
+      cli   = timecard.TimeCardCLI(path)
+      quietly(cli.do_update, '')
+      conn  = cli.engine.connect()
+      conn.execute(timecard.TimeEntry.__table__.insert(), [{
+        'date':           first + timecard.datetime.timedelta(days=idx / 8),
+        'start_time':     timecard.datetime.time(9 + idx % 8),
+        'end_time':       timecard.datetime.time(10 + idx % 8),
+        'billable':       False,
+        'department_id':  1,
+        'project_id':     1,
+        'task_id':        1,
+        'description':    'Benchmark entry %d' % idx,
+        'notes':          '',
+      } for idx in range(days * 8)])
+      conn.close()
+      quietly(cli.do_reconcile, '-s %s -e %s -p -c 8' % (first, last))
+      for workers in (1, 4, 8, 16):
+        seconds = quietly(cli.do_reconcile, '-s %s -e %s -c %d' % 
+                                            (first, last, workers))
+        print '%-8d %-8d %-8d %-10.3f %-10.1f' %\
+              (days, latency, workers, seconds, days / seconds)
+    finally:
+      mock.stop()
+      shutil.rmtree(path)
+
+
+benchmarks = {
+  'catalogue': bench_catalogue,
+  'startup':   bench_startup,
+  'api':       bench_api,
+  'update':    bench_update,
+  'push':      bench_push,
+  'reconcile': bench_reconcile,
+}
+
+if __name__ == '__main__':
+  for name in sys.argv[1:] or sorted(benchmarks.keys()):
+    print '== %s ==' % name
+    benchmarks[name]()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+'''
+TimeCard Client
+
+A thin client for the TimeCard daemon.  Start the daemon once with:
+
+  timecard.py --daemon
+
+and then run commands through this script just like you would through
+timecard.py itself (e.g. "tcclient.py show -d 2012-05-01").  This script only
+uses the standard library so it starts quickly, and if the daemon isn't
+running the command is simply handed off to timecard.py instead.
+'''
+
+import os
+import sys
+import socket
+
+path = os.path.join(sys.path[0], 'timecard.sock')
+
+def forward(line):
+  '''
+  forward(line)
+  Sends the command line to the daemon and writes out the response.  Returns
+  False if the daemon could not be reached.
+  '''
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(path)
+  except socket.error:
+    return False
+  client.sendall(line + '\n')
+  while True:
+    data = client.recv(65536)
+    if data == '':
+      break
+    sys.stdout.write(data)
+  client.close()
+  return True
+
+if __name__ == '__main__':
+  # Options for timecard.py itself (like --stats) only make sense for a fresh
+  # run, so those are always handed off.
+  if len(sys.argv) > 1 and not sys.argv[1].startswith('--') and\
+     forward(' '.join(sys.argv[1:])):
+    sys.exit()
+  script = os.path.join(sys.path[0], 'timecard.py')
+  os.execv(sys.executable, [sys.executable, script] + sys.argv[1:])
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+'''
+TimeCard Tests
+
+Behavioural tests for the parts of TimeCard that talk to ATRWeb or move a
+lot of rows around.  They run against the mock ATRWeb server (see
+atrmock.py) and a scratch config and database, so they don't need a live
+host and leave the real database alone.  Usage:
+
+  python -m unittest test_timecard
+'''
+
+import os
+import sys
+import shutil
+import unittest
+import StringIO
+import threading
+import timecard
+from atrmock import MockATR
+from benchmark import scratch
+
+try:
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+
+class MockTestCase(unittest.TestCase):
+  '''
+  Starts a mock ATRWeb server and a TimeCardCLI pointed at it for every test,
+  with the catalogue already pulled down.
+  '''
+  catalogue = (100, 1000)
+
+  def setUp(self):
+    projects, tasks = self.catalogue
+    self.mock = MockATR(projects=projects, tasks=tasks).start()
+    self.path = scratch(self.mock.host)
+    self.cli  = timecard.TimeCardCLI(self.path)
+    self.run_cmd(self.cli.do_update, '')
+    self.mock.reset()
+
+  def tearDown(self):
+    self.mock.stop()
+    shutil.rmtree(self.path)
+
+  def run_cmd(self, func, *args):
+    '''
+    run_cmd(func, *args)
+    Runs the command and returns everything that it printed.
+    '''
+    output      = StringIO.StringIO()
+    stdout      = sys.stdout
+    sys.stdout  = output
+    try:
+      func(*args)
+    finally:
+      sys.stdout = stdout
+    return output.getvalue()
+
+  def add_entries(self, count, date=timecard.datetime.date(2012, 5, 1),
+                  per_day=8, **values):
+    '''
+    add_entries(count, date=2012-05-01, per_day=8, **values)
+    Inserts count hour long entries starting on the date, per_day of them to
+    a day.  Any values given override the defaults for every entry.
+    '''
+    conn  = self.cli.engine.connect()
+    conn.execute(timecard.TimeEntry.__table__.insert(), [dict({
+      'date':           date + timecard.datetime.timedelta(days=i / per_day),
+      'start_time':     timecard.datetime.time(8 + i % per_day),
+      'end_time':       timecard.datetime.time(9 + i % per_day),
+      'billable':       False,
+      'department_id':  1,
+      'project_id':     1,
+      'task_id':        1,
+      'description':    'Entry %d' % i,
+      'notes':          '',
+    }, **values) for i in range(count)])
+    conn.close()
+
+  def execute(self, sql):
+    '''
+    execute(sql)
+    Runs the statement against the CLI's database.
+    '''
+    conn  = self.cli.engine.connect()
+    conn.execute(sql)
+    conn.close()
+
+  def scalar(self, sql):
+    '''
+    scalar(sql)
+    Runs the query against the CLI's database and returns the first column of
+    the first row.
+    '''
+    conn  = self.cli.engine.connect()
+    try:
+      return conn.execute(sql).scalar()
+    finally:
+      conn.close()
+
+
+class PushTest(MockTestCase):
+  def test_ledger_skips_pushed_entries(self):
+    self.add_entries(5)
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    self.assertEqual(self.mock.stats.get('operate'), 5)
+    output = self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    self.assertEqual(self.mock.stats.get('operate'), 5)
+    self.assertTrue('Skipping 5 entries' in output)
+
+  def test_changed_entry_is_pushed_again(self):
+    self.add_entries(3)
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    self.execute("UPDATE entry SET notes = 'changed' WHERE id = 2")
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    self.assertEqual(self.mock.stats.get('operate'), 4)
+
+  def test_force_pushes_everything(self):
+    self.add_entries(3)
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01 -f')
+    self.assertEqual(self.mock.stats.get('operate'), 6)
+
+
+class UpdateTest(MockTestCase):
+  catalogue = (1000, 10000)
+
+  def counts(self):
+    return (self.scalar('SELECT count(*) FROM project'),
+            self.scalar('SELECT count(*) FROM task'))
+
+  def test_large_change_keeps_unchanged_rows(self):
+    # 100 new tasks touch 100 projects and well over 900 ids, which is more
+    # than fits in one IN list.
+    self.mock.catalogue(1000, 10100)
+    self.run_cmd(self.cli.do_update, '')
+    self.assertEqual(self.counts(), (1000, 10100))
+    output = self.run_cmd(self.cli.do_update, '-f')
+    self.assertEqual(self.counts(), (1000, 10100))
+    self.assertTrue('0 added,      0 changed,      0 removed' in output)
+
+  def test_removed_projects(self):
+    self.mock.catalogue(900, 10000)
+    self.run_cmd(self.cli.do_update, '')
+    self.assertEqual(self.counts(), (900, 10000))
+
+
+class OutboxTest(MockTestCase):
+  def outbox(self):
+    return self.scalar('SELECT count(*) FROM outbox')
+
+  def test_failed_entries_are_queued_and_drained(self):
+    self.add_entries(4)
+    self.mock.errors = 1
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    self.assertEqual(self.outbox(), 4)
+
+    # A failed retry backs off, so a due drain straight after sends nothing.
+    self.assertEqual(self.cli._drain(due=False), (0, 4, 0))
+    self.assertEqual(self.scalar('SELECT min(attempts) FROM outbox'), 1)
+    self.mock.errors = 0
+    self.assertEqual(self.cli._drain(), (0, 0, 0))
+    self.assertEqual(self.cli._drain(due=False), (4, 0, 0))
+    self.assertEqual(self.outbox(), 0)
+    self.assertEqual(self.mock.stats.get('operate'), 4)
+
+  def test_queue_then_drain(self):
+    self.add_entries(3)
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01 -q')
+    self.assertEqual(self.outbox(), 3)
+    self.assertEqual(self.mock.stats.get('operate'), None)
+    self.run_cmd(self.cli.do_drain, '-a')
+    self.assertEqual(self.outbox(), 0)
+    self.assertEqual(self.mock.stats.get('operate'), 3)
+
+  def test_push_during_drain_sends_once(self):
+    self.add_entries(8)
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01 -q')
+    self.mock.latency = 20
+    thread = threading.Thread(target=self.cli._drain, args=(False,))
+    thread.start()
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    thread.join()
+    self.assertEqual(self.mock.stats.get('operate'), 8)
+
+  def test_unreachable_host_queues(self):
+    self.add_entries(2)
+    self.mock.expire_sessions()
+    self.mock.password = 'something else'
+    self.cli.api.cookie = None
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01')
+    self.assertEqual(self.outbox(), 2)
+    self.assertEqual(self.mock.stats.get('operate'), None)
+
+
+class ReportTest(MockTestCase):
+  def test_group_by_week(self):
+    # 2012-05-05 is a Saturday and 2012-05-06 a Sunday, so these fall in the
+    # weeks starting 2012-04-29 and 2012-05-06.
+    self.add_entries(3, timecard.datetime.date(2012, 5, 5), per_day=3)
+    self.add_entries(2, timecard.datetime.date(2012, 5, 6), per_day=2)
+    self.add_entries(1, timecard.datetime.date(2012, 5, 12), per_day=1)
+    output = self.run_cmd(self.cli.do_report,
+                          '-s 2012-04-01 -e 2012-06-01 -g week -c')
+    self.assertEqual(output.splitlines(), [
+      'WEEK,HOURS,ENTRIES',
+      '2012-04-29,3.00,3',
+      '2012-05-06,3.00,3',
+    ])
+
+  def test_group_by_week_and_project(self):
+    self.add_entries(2, timecard.datetime.date(2012, 5, 7), per_day=2)
+    self.add_entries(1, timecard.datetime.date(2012, 5, 8), per_day=1,
+                     project_id=2, task_id=2)
+    output = self.run_cmd(self.cli.do_report,
+                          '-s 2012-05-01 -e 2012-05-31 -g week,project -c')
+    self.assertEqual(output.splitlines(), [
+      'WEEK,PROJ,PROJECT,HOURS,ENTRIES',
+      '2012-05-06,1,Project 0,2.00,2',
+      '2012-05-06,2,Project 1,1.00,1',
+    ])
+
+
+class ExportTest(MockTestCase):
+  @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+  def test_parquet_across_blocks(self):
+    # The notes are empty for the whole first block and filled in after it,
+    # so the schema can't come from the first block.
+    self.add_entries(5000, notes=None)
+    self.add_entries(7000, timecard.datetime.date(2020, 1, 1), notes='Later')
+    path  = os.path.join(self.path, 'entries.parquet')
+    self.run_cmd(self.cli.do_export, path)
+    data  = pyarrow.parquet.ParquetFile(path)
+    table = data.read()
+    self.assertEqual(table.num_rows, 12000)
+    self.assertEqual(data.num_row_groups, 3)
+    self.assertEqual(str(table.schema.field_by_name('notes').type), 'string')
+    self.assertEqual(str(table.schema.field_by_name('id').type), 'int64')
+    self.assertEqual(table.column('notes').to_pylist()[-1], 'Later')
+
+  def test_csv_round_trip(self):
+    self.add_entries(3)
+    path  = os.path.join(self.path, 'entries.csv')
+    self.run_cmd(self.cli.do_export, path)
+    self.execute('DELETE FROM entry')
+    self.run_cmd(self.cli.do_import, path)
+    self.assertEqual(self.scalar('SELECT count(*) FROM entry'), 3)
+
+
+class ReconcileTest(MockTestCase):
+  def setUp(self):
+    MockTestCase.setUp(self)
+    self.add_entries(4)
+    # One at a time, so the mock server has the entries in order.
+    self.run_cmd(self.cli.do_push, '-d 2012-05-01 -c 1')
+
+  def reconcile(self, args=''):
+    return self.run_cmd(self.cli.do_reconcile, '-s 2012-05-01 ' + args)
+
+  def test_in_sync(self):
+    output = self.reconcile()
+    self.assertTrue('4 local, 4 on ATRWeb, 0 missing, 0 extra, '
+                    '0 mismatched' in output)
+
+  def test_missing_extra_mismatch(self):
+    del self.mock.entries[0]
+    self.mock.entries[0]['txt_notes'] = 'Changed on ATRWeb'
+    extra = dict(self.mock.entries[-1], dtm_from='17:00', dtm_to='18:00')
+    self.mock.entries.append(extra)
+    output = self.reconcile()
+    self.assertTrue('MISSING  08:00-09:00 entry 1' in output)
+    self.assertTrue('MISMATCH 09:00-10:00 entry 2' in output)
+    self.assertTrue('notes' in output)
+    self.assertTrue('EXTRA    17:00-18:00' in output)
+    self.assertTrue('1 missing, 1 extra, 1 mismatched' in output)
+
+  def test_push_respects_ledger(self):
+    self.mock.reset()
+    output = self.reconcile('-p')
+    self.assertTrue('Skipping 4 missing entries' in output)
+    self.assertEqual(self.mock.stats.get('operate'), None)
+    self.reconcile('-p -f')
+    self.assertEqual(self.mock.stats.get('operate'), 4)
+    self.assertTrue('0 missing' in self.reconcile())
+
+  def test_unreadable_page_is_an_error(self):
+    self.mock.reset()
+    self.mock.page = lambda date, employee: self.mock._page
+    output = self.reconcile('-p -f')
+    self.assertTrue('ERROR' in output)
+    self.assertTrue('0 missing' in output)
+    self.assertEqual(self.mock.stats.get('operate'), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,20 +1,31 @@
 #!/usr/bin/env python
 
-import httplib
-import urllib
 import datetime
+import hashlib
+import re
+import threading
+import time
 import os
 import sys
 import getopt
 import cmd
+import Queue
+import bisect
 from ConfigParser               import ConfigParser
-from BeautifulSoup              import BeautifulSoup    as bsoup
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy                 import Table, Column, Integer, String, Time, \
                                        DateTime, Date, ForeignKey, Text,     \
                                        Boolean, create_engine, MetaData,     \
-                                       and_, or_
-from sqlalchemy.orm             import relationship, backref, sessionmaker
+                                       and_, or_, select, bindparam, Index, \
+                                       func, cast, case
+from sqlalchemy.orm             import relationship, backref, sessionmaker, \
+                                       joinedload, subqueryload
+from sqlalchemy                 import event
+from sqlalchemy.exc             import OperationalError
+
+# httplib, urllib, and BeautifulSoup are imported where they are used, so that
+# the commands that only work with the local database don't have to pay for
+# loading them.
 
 Base            = declarative_base()
 
@@ -34,6 +45,17 @@ default_config = '''
 # same department.  Note that this needs to be an integer.
 default_department = 0
 
+# If enabled, the number of SQL statements that each command ran is printed
+# after the command has finished.
+count_queries = no
+
+# The check command reports any unlogged time between a day's entries that is
+# at least this many minutes long.  If check_before_push is enabled, push will
+# refuse to send days that have overlapping entries or gaps (push --no-check
+# skips this for one push).
+min_gap = 1
+check_before_push = no
+
 [ATR]
 # This is your ATRWeb Username
 username = USERNAME
@@ -47,13 +69,54 @@ host = infrastructuretime
 # Is the ATRWeb environment we are connecting to SSL enabled?
 ssl = yes
 
+# How many idle keep-alive connections to ATRWeb we will hold onto, and how
+# long (in seconds) an idle connection is kept before we throw it away and
+# open a fresh one.
+pool_size = 4
+idle_timeout = 30
+
+# The number of entries that push will send to ATRWeb at the same time.
+push_workers = 4
+
+# Entries in the outbox that fail to send are retried after retry_base
+# seconds, doubling after every failure up to retry_max seconds.  While the
+# interactive prompt is open, the outbox is drained in the background every
+# drain_interval seconds (0 turns this off).
+retry_base = 30
+retry_max = 3600
+drain_interval = 60
+
 # This is the Employee id (sel_names) that ATR uses internally.  This number
 # can be found if you login to the site, then goto a specific day and look at
 # the URL.  you should see a sel_names (or similar) part of the URL with a
 # number associated with it.  That number is what you will need to put here.
 employee_id = 0
+
+# Roster mode lets one person enter and push time for other people too.  Add
+# a section like the one below for each employee, then use -E NAME with add,
+# run, show, check, and push, or roster_push to push for everyone at once.
+# host and ssl default to the ones above.
+#
+# [Employee alice]
+# username = alice
+# password = PASSWORD
+# employee_id = 0
 '''
 
+# These are the fallback values for any options that may be missing from
+# config files that were written by older versions of TimeCard.
+config_defaults = {
+  'pool_size': '4',
+  'idle_timeout': '30',
+  'push_workers': '4',
+  'count_queries': 'no',
+  'min_gap': '1',
+  'check_before_push': 'no',
+  'retry_base': '30',
+  'retry_max': '3600',
+  'drain_interval': '60',
+}
+
 class Department(Base):
   __tablename__ = 'department'
   id            = Column(Integer, primary_key=True)
@@ -93,27 +156,6 @@ class Action(Base):
   billable      = Column(Boolean)
   description   = Column(Text)
   notes         = Column(Text)
-  
-  def gen_entry(self, t, values):
-    desc    = self.description
-    notes   = self.notes
-    for item in values:
-      desc  = desc.replace('{%s}' % item, values[item])
-      notes = notes.replace('{%s}' % item, values[item])
-    entry               = TimeEntry()
-    entry.date          = datetime.date(t.year, t.month, t.day)
-    entry.start_time    = datetime.time(t.hour, t.minute)
-    entry.end_time      = (datetime.datetime(t.year, t.month, t.day ,
-                                             t.hour, t.minute) +\
-                          datetime.timedelta(minutes=self.duration)).time()
-    entry.billable      = self.billable
-    entry.department_id = self.department_id
-    entry.project_id    = self.project_id
-    entry.task_id       = self.task_id
-    entry.description   = desc
-    entry.notes         = notes
-    return entry
-    
 
 class TimeEntry(Base):
   __tablename__ = 'entry'
@@ -131,26 +173,621 @@ class TimeEntry(Base):
   billable      = Column(Boolean)
   description   = Column(Text)
   notes         = Column(Text)
+  employee      = Column(Text)
+  
+  def digest(self):
+    '''
+    Returns a hash of everything about the entry that gets sent to ATRWeb so
+    that we can tell if the entry has changed since it was last pushed.  The
+    employee is only part of the hash for roster entries, so that the entries
+    pushed before roster mode existed keep the same hash.
+    '''
+    values = (self.date, self.start_time, self.end_time, self.billable,
+              self.department_id, self.project_id, self.task_id,
+              self.description, self.notes)
+    if self.employee is not None:
+      values += (self.employee,)
+    return hashlib.sha1(u'\x00'.join([unicode(v) for v in values])\
+                                    .encode('utf-8')).hexdigest()
+
+Index('ix_entry_date', TimeEntry.date, TimeEntry.start_time)
+Index('ix_task_project', Task.project_id)
+Index('ix_action_template', Action.template_id, Action.stack)
+Index('ix_entry_employee', TimeEntry.employee, TimeEntry.date)
+
+class PushRecord(Base):
+  __tablename__ = 'push'
+  entry_id      = Column(Integer, ForeignKey('entry.id'), primary_key=True)
+  pushed        = Column(DateTime)
+  digest        = Column(Text)
+  response      = Column(Text)
+
+class Outbox(Base):
+  __tablename__ = 'outbox'
+  entry_id      = Column(Integer, ForeignKey('entry.id'), primary_key=True)
+  queued        = Column(DateTime)
+  attempts      = Column(Integer)
+  next_try      = Column(DateTime)
+  last_error    = Column(Text)
+
+class Fingerprint(Base):
+  __tablename__ = 'fingerprint'
+  name          = Column(Text, primary_key=True)
+  digest        = Column(Text)
+
+class Schedule(Base):
+  __tablename__ = 'schedule'
+  id            = Column(Integer, primary_key=True)
+  template_id   = Column(Integer, ForeignKey('template.id'))
+  template      = relationship('Template', backref='schedules')
+  start_time    = Column(Time)
+  days          = Column(Text)
+  interval      = Column(Integer)
+  first         = Column(Date)
+  through       = Column(Date)
+  fields        = Column(Text)
+  
+  day_names     = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+  
+  @classmethod
+  def parse_rule(cls, words):
+    '''
+    parse_rule(words)
+    Parses a recurrence rule into the weekdays (as a string of weekday
+    numbers, monday being 0) and the interval in weeks.  The rules are:
+    
+      daily
+      weekdays
+      weekly DAYS
+      every [other|N weeks] [on] DAYS
+    
+    DAYS is a comma or space separated list of day names (mon, tue, ...).
+    Raises ValueError if the rule doesn't make sense.
+    '''
+    words     = [w.lower() for w in ' '.join(words).replace(',', ' ').split()]
+    interval  = 1
+    if words == ['daily']:
+      return '0123456', 1
+    if words == ['weekdays']:
+      return '01234', 1
+    if len(words) > 0 and words[0] == 'weekly':
+      words = words[1:]
+    elif len(words) > 0 and words[0] == 'every':
+      words = words[1:]
+      if len(words) > 0 and words[0] == 'other':
+        interval  = 2
+        words     = words[1:]
+      elif len(words) > 1 and words[1] in ('week', 'weeks'):
+        try:
+          interval = int(words[0])
+        except ValueError:
+          raise ValueError('Invalid interval %s' % words[0])
+        words     = words[2:]
+      if len(words) > 0 and words[0] == 'on':
+        words = words[1:]
+    else:
+      raise ValueError('Unknown rule')
+    days = set()
+    for word in words:
+      if word[:3] not in cls.day_names:
+        raise ValueError('Invalid day %s' % word)
+      days.add(str(cls.day_names.index(word[:3])))
+    if len(days) == 0 or interval < 1:
+      raise ValueError('No days given')
+    return ''.join(sorted(days)), interval
+  
+  def due(self, date):
+    '''
+    due(date)
+    Returns True if the schedule has an occurrence on the date.  The weeks for
+    the interval are counted from the week of the first date.
+    '''
+    if date < self.first or str(date.weekday()) not in self.days:
+      return False
+    anchor = self.first - datetime.timedelta(days=self.first.weekday())
+    return ((date - anchor).days // 7) % self.interval == 0
+  
+  def describe(self):
+    '''
+    Returns the schedule's rule in the same form that parse_rule takes.
+    '''
+    if self.interval == 1 and self.days == '0123456':
+      return 'daily'
+    if self.interval == 1 and self.days == '01234':
+      return 'weekdays'
+    days = ','.join([self.day_names[int(d)] for d in self.days])
+    if self.interval == 1:
+      return 'weekly %s' % days
+    if self.interval == 2:
+      return 'every other %s' % days
+    return 'every %d weeks %s' % (self.interval, days)
+
+# This is the order of the kinds of rows in the search index.  The rowid of
+# each row in the index is the row's id * 4 + the kind's position in here.
+search_kinds = ['department', 'project', 'task', 'template']
+
+def search_index(conn):
+  '''
+  search_index(conn)
+  Builds the full text search index over the departments, projects, tasks,
+  and templates.  If sqlite wasn't built with FTS5 there won't be an index
+  and search will fall back to plain LIKE queries.  Returns True if the
+  index was built.
+  '''
+  try:
+    conn.execute("CREATE VIRTUAL TABLE search USING fts5(name, description, "
+                 "parent UNINDEXED, tokenize='unicode61', prefix='2 3')")
+  except OperationalError:
+    return False
+  conn.execute('INSERT INTO search (rowid, name) '
+               'SELECT id * 4, name FROM department')
+  conn.execute('INSERT INTO search (rowid, name) '
+               'SELECT id * 4 + 1, name FROM project')
+  conn.execute('INSERT INTO search (rowid, name, parent) '
+               'SELECT id * 4 + 2, name, project_id FROM task')
+  conn.execute('INSERT INTO search (rowid, name, description) '
+               'SELECT id * 4 + 3, name, description FROM template')
+  return True
+
+def entry_employee(conn):
+  '''
+  entry_employee(conn)
+  Adds the employee column for roster mode to the entry table, unless the
+  table was just created with it.
+  '''
+  columns = [r[1] for r in conn.execute('PRAGMA table_info(entry)')]
+  if 'employee' not in columns:
+    conn.execute('ALTER TABLE entry ADD COLUMN employee TEXT')
+  conn.execute('CREATE INDEX IF NOT EXISTS ix_entry_employee '
+               'ON entry (employee, date)')
+
+# These are the schema migrations for existing databases.  Each item in the
+# list is the set of statements that brings the database up to that version
+# (the first item is version 1), or a function that is called with the
+# connection to do it.  The version that a database is at is kept in sqlite's
+# user_version pragma.  New migrations always go on the end.  The tables are
+# only created from the models when the database is behind, so adding a new
+# model also needs a migration (even an empty one) to bump the version.
+migrations = [
+  # Version 1: Indexes for the entry date lookups and the common joins.
+  ['CREATE INDEX IF NOT EXISTS ix_entry_date ON entry (date, start_time)',
+   'CREATE INDEX IF NOT EXISTS ix_task_project ON task (project_id)',
+   'CREATE INDEX IF NOT EXISTS ix_action_template '
+   'ON action (template_id, stack)',
+  ],
+  # Version 2: The full text search index.
+  search_index,
+  # Version 3: The schedule table (created from the model).
+  [],
+  # Version 4: The outbox table (created from the model).
+  [],
+  # Version 5: The employee column on entries for roster mode.
+  entry_employee,
+]
+
+class ATRError(Exception):
+  '''
+  Raised when ATRWeb responds to a request with an error status.
+  '''
+  pass
+
+
+class Stats(object):
+  '''
+  Counters for where the time in a command goes.  Nothing is measured unless
+  a Stats object has been handed to the CLI (the --stats option), so all that
+  it costs otherwise is a check for None in the few places that record into
+  it.  The HTTP counters are updated from the push worker threads, so they
+  are kept under a lock.
+  '''
+  # The upper bounds (in milliseconds) of the HTTP latency histogram buckets.
+  buckets = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+  
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+  
+  def reset(self):
+    '''
+    Zeroes all of the counters.
+    '''
+    self.started    = time.time()
+    self.requests   = 0
+    self.sent       = 0
+    self.received   = 0
+    self.http_time  = 0.0
+    self.histogram  = [0] * (len(self.buckets) + 1)
+    self.parse_time = 0.0
+    self.statements = 0
+    self.commits    = 0
+  
+  def http(self, seconds, sent, received):
+    '''
+    http(seconds, sent, received)
+    Records one HTTP request and how many bytes went each way.
+    '''
+    bucket = bisect.bisect_left(self.buckets, seconds * 1000)
+    with self.lock:
+      self.requests   += 1
+      self.sent       += sent
+      self.received   += received
+      self.http_time  += seconds
+      self.histogram[bucket] += 1
+  
+  def parse(self, seconds):
+    '''
+    parse(seconds)
+    Records time spent parsing ATRWeb pages.
+    '''
+    with self.lock:
+      self.parse_time += seconds
+  
+  def statement(self, *args):
+    '''
+    SQLAlchemy event hook that counts the statements run.
+    '''
+    self.statements += 1
+  
+  def commit(self, *args):
+    '''
+    SQLAlchemy event hook that counts the commits.
+    '''
+    self.commits += 1
+  
+  def report(self):
+    '''
+    Returns the counters as a few lines of text.
+    '''
+    lines = ['wall %.3fs' % (time.time() - self.started)]
+    if self.requests > 0:
+      lines.append('http %d requests, %.3fs, %.1f KB sent, %.1f KB received'
+                   % (self.requests, self.http_time, self.sent / 1024.0, 
+                      self.received / 1024.0))
+      labels = ['<%dms' % b for b in self.buckets] +\
+               ['>=%dms' % self.buckets[-1]]
+      lines.append('     ' + ' '.join(['%s:%d' % (labels[i], count) 
+                    for i, count in enumerate(self.histogram) if count > 0]))
+    if self.parse_time > 0:
+      lines.append('parse %.3fs' % self.parse_time)
+    lines.append('sql %d statements, %d commits' % (self.statements, 
+                                                   self.commits))
+    return '\n'.join(['(%s)' % line for line in lines])
+
+
+class ConnectionPool(object):
+  '''
+  A small pool of keep-alive connections to a single host.  Idle connections
+  are handed back out newest first so that the warmest socket gets reused, and
+  anything that has been sitting idle longer than the timeout is closed
+  instead of risking a socket the server has already given up on.
+  '''
+  def __init__(self, host, ssl=False, size=4, timeout=30):
+    '''
+    __init__(host, ssl=False, size=4, timeout=30)
+    Initializes the pool.  size is the maximum number of idle connections
+    that we will keep around and timeout is the number of seconds an idle
+    connection is considered to still be usable.
+    '''
+    self.host     = host
+    self.size     = size
+    self.timeout  = timeout
+    self.idle     = []
+    self.lock     = threading.Lock()
+    import httplib
+    if ssl:
+      self.con    = httplib.HTTPSConnection
+    else:
+      self.con    = httplib.HTTPConnection
+  
+  def _acquire(self):
+    '''
+    Private Function:  Returns a connection and a flag stating if the
+    connection is a reused one.
+    '''
+    now = time.time()
+    with self.lock:
+      while len(self.idle) > 0:
+        http, last = self.idle.pop()
+        if now - last < self.timeout:
+          return http, True
+        http.close()
+    return self.con(self.host), False
+  
+  def _release(self, http):
+    '''
+    Private Function:  Hands a connection back to the pool, or closes it if
+    the pool is already full.
+    '''
+    with self.lock:
+      if len(self.idle) < self.size:
+        self.idle.append((http, time.time()))
+        return
+    http.close()
+  
+  def request(self, method, url, body=None, headers={}, parser=None):
+    '''
+    request(method, url, body=None, headers={}, parser=None)
+    Sends the request over a pooled connection and returns the response object
+    along with the response body.  If a reused connection turns out to have
+    been dropped by the server we will quietly reconnect and try again, but
+    only when we know the server never saw the request (the send itself failed
+    or the connection closed without a status line), or when the request is a
+    GET.  Anything else may already have been acted on, so it is raised rather
+    than risk posting the same entry twice.  If a parser is given, the body is
+    fed into the parser as it arrives instead of being held onto, and only the
+    first block of the body is returned.
+    '''
+    import httplib
+    import socket
+    while True:
+      http, reused = self._acquire()
+      sent          = False
+      try:
+        http.request(method, url, body, headers)
+        sent  = True
+        resp  = http.getresponse()
+        if parser is None:
+          data  = resp.read()
+        else:
+          parser.reset()
+          data  = self._stream(resp, parser)
+      except (httplib.HTTPException, socket.error), error:
+        http.close()
+        if reused and (not sent or method == 'GET' or self._dropped(error)):
+          continue
+        raise
+      if resp.will_close:
+        http.close()
+      else:
+        self._release(http)
+      return resp, data
+  
+  def _dropped(self, error):
+    '''
+    Private Function:  Returns True if the error means the server closed the
+    connection before it sent back any part of a response.
+    '''
+    import httplib
+    if not isinstance(error, httplib.BadStatusLine):
+      return False
+    return error.line in ('', "''") or error.line.startswith('No status line')
+  
+  def _stream(self, resp, parser):
+    '''
+    Private Function:  Reads the response body in blocks, handing each block
+    to the parser.  Once the parser has everything it wants the rest of the
+    body is still read (so the connection can be reused) but not parsed.
+    '''
+    head  = None
+    while True:
+      block = resp.read(16384)
+      if block == '':
+        return head or ''
+      if head is None:
+        head = block
+      parser.feed(block)
+  
+  def close(self):
+    '''
+    Closes all of the idle connections in the pool.
+    '''
+    with self.lock:
+      while len(self.idle) > 0:
+        self.idle.pop()[0].close()
+
+
+class DayInfoParser(object):
+  '''
+  Incremental scanner for the DayInfo.asp page.  Instead of building a
+  document tree for the whole page, the page is fed in as it comes off of the
+  wire and we only hang onto the department select and the three javascript
+  arrays (Np, Kp, and TaskArray) that make up the project catalogue.
+  '''
+  patterns  = {
+    'departments':  (re.compile(r'<select[^>]*name\s*=\s*["\']?ddl_abbr\b', re.I),
+                     re.compile(r'</select', re.I)),
+    'names':        (re.compile(r'\bNp\s*=\s*new Array\('), 
+                     re.compile(r'[\r\n]')),
+    'ids':          (re.compile(r'\bKp\s*=\s*new Array\('),
+                     re.compile(r'[\r\n]')),
+    'tasks':        (re.compile(r'\bTaskArray\s*=\s*new Array\('),
+                     re.compile(r'[\r\n]')),
+  }
+  js_string = re.compile(r'"((?:[^"\\]|\\.)*)"')
+  js_task   = re.compile(r"\(\s*(-?\d+)\s*,\s*'((?:[^'\\]|\\.)*)'\s*,\s*(-?\d+)\s*\)")
+  js_escape = re.compile(r'\\(.)')
+  overlap   = 256
+  encoding  = 'cp1252'
+  
+  def __init__(self):
+    self.reset()
+  
+  def reset(self):
+    '''
+    Throws away anything that has been fed into the parser so far.
+    '''
+    self.buffer = ''
+    self.offset = 0
+    self.starts = {}
+    self.scans  = {}
+    self.found  = {}
+  
+  def done(self):
+    '''
+    Returns True once everything that we are looking for has been found.
+    '''
+    return len(self.found) == len(self.patterns)
+  
+  def feed(self, data):
+    '''
+    feed(data)
+    Feeds the next block of the page into the parser.
+    '''
+    if self.done():
+      return
+    self.buffer += data
+    for key, (start, end) in self.patterns.items():
+      if key in self.found:
+        continue
+      if key not in self.starts:
+        match = start.search(self.buffer, self.offset)
+        if match is None:
+          continue
+        self.starts[key]  = match.end()
+        self.scans[key]   = match.end()
+      match = end.search(self.buffer, self.scans[key])
+      if match is None:
+        self.scans[key]   = max(self.starts[key], len(self.buffer) - 16)
+      else:
+        self.found[key]   = self.buffer[self.starts.pop(key):match.start()]
+        del self.scans[key]
+    
+    # Anything that is behind both the start marker search and every capture
+    # that is still in progress is never going to be looked at again, so we
+    # drop it to keep the buffer small.
+    self.offset = max(0, len(self.buffer) - self.overlap)
+    cut = min([self.offset] + self.starts.values())
+    self.buffer = self.buffer[cut:]
+    self.offset -= cut
+    for key in self.starts:
+      self.starts[key]  -= cut
+      self.scans[key]   -= cut
+  
+  def text(self, key):
+    '''
+    text(key)
+    Returns the decoded text that was captured for the key, or an empty
+    string if the page did not have it.
+    '''
+    return self.found.get(key, '').decode(self.encoding, 'replace')
+  
+  def departments(self):
+    '''
+    Returns a dictionary of the department ids and names from the ddl_abbr
+    select.
+    '''
+    deps      = {}
+    import HTMLParser
+    unescape  = HTMLParser.HTMLParser().unescape
+    for attrs, name in re.findall(r'<option([^>]*)>([^<]*)', 
+                                  self.text('departments'), re.I):
+      value = re.search(r'value\s*=\s*["\']?(-?\d+)', attrs, re.I)
+      if value is not None:
+        deps[int(value.group(1))] = unescape(name.strip())
+    return deps
+  
+  def catalogue(self):
+    '''
+    Returns the department and project catalogue from the page in the form
+    of {'departments': {id: name}, 'projects': {id: {'value': name, 
+    'tasks': {id: name}}}}.
+    '''
+    db    = {'departments': self.departments(), 'projects': {}}
+    
+    # The Np and Kp arrays are parallel arrays of the project names and ids,
+    # and every entry in TaskArray is a (project id, task name, task id)
+    # triplet.  We walk each of them exactly once, so this stays linear no
+    # matter how large the catalogue gets.
+    names = [self._unquote(n) 
+             for n in self.js_string.findall(self.text('names'))]
+    ids   = [self._unquote(n) 
+             for n in self.js_string.findall(self.text('ids'))]
+    for pid, name in zip(ids, names):
+      try:
+        db['projects'][int(pid)] = {'tasks': {}, 'value': name}
+      except ValueError:
+        # ATRWeb will occasionally stuff an "Error!" value in the array.
+        continue
+    for pid, name, tid in self.js_task.findall(self.text('tasks')):
+      project = db['projects'].get(int(pid))
+      if project is not None:
+        project['tasks'][int(tid)] = self._unquote(name)
+    return db
+  
+  def _unquote(self, value):
+    '''
+    Private Function:  Removes javascript backslash escaping from a string.
+    '''
+    return self.js_escape.sub(r'\1', value)
+
+
+class DayEntriesParser(DayInfoParser):
+  '''
+  Incremental scanner for the entries that ATRWeb already holds for the day
+  on a DayInfo.asp page.  These are in the TimingArray javascript array, one
+  new Array(timing id, 'from', 'to', department id, project id, task id,
+  'description', 'notes', billable) for each entry.  Only that array is
+  captured, so the scan can stop as soon as it has been read.
+  '''
+  patterns  = {
+    'timings':      (re.compile(r'\bTimingArray\s*=\s*new Array\('),
+                     re.compile(r'[\r\n]')),
+  }
+  js_timing = re.compile(r"new Array\(\s*(-?\d+)\s*,\s*'(\d+:\d+)'\s*,"
+                         r"\s*'(\d+:\d+)'\s*,\s*(-?\d+)\s*,\s*(-?\d+)\s*,"
+                         r"\s*(-?\d+)\s*,\s*'((?:[^'\\]|\\.)*)'\s*,"
+                         r"\s*'((?:[^'\\]|\\.)*)'\s*,\s*(\d+)\s*\)")
+  
+  def entries(self):
+    '''
+    Returns the entries from the page as a list of dictionaries with the
+    timing id and the same fields as a TimeEntry.  A task id of 0 or less
+    means the entry has no task.  Raises an ATRError if the page has no
+    TimingArray, or has entries in it that can't be read, since an empty
+    list would otherwise say that ATRWeb has nothing for the day.
+    '''
+    if 'timings' not in self.found:
+      raise ATRError('The page does not have a TimingArray')
+    text    = self.text('timings')
+    timings = self.js_timing.findall(text)
+    if len(timings) != text.count('new Array('):
+      raise ATRError('Could only read %d of the %d entries in the '
+                     'TimingArray' % (len(timings), text.count('new Array(')))
+    entries = []
+    for timing in timings:
+      tid, start, end, dept, project, task, desc, notes, billable = timing
+      entries.append({
+        'id':             int(tid),
+        'start_time':     datetime.time(*[int(i) for i in start.split(':')]),
+        'end_time':       datetime.time(*[int(i) for i in end.split(':')]),
+        'department_id':  int(dept),
+        'project_id':     int(project),
+        'task_id':        int(task) if int(task) > 0 else None,
+        'description':    self._unquote(desc),
+        'notes':          self._unquote(notes),
+        'billable':       billable != '0',
+      })
+    return entries
 
 class TimeCardAPI(object):
-  cookie = None
+  cookie      = None
+  stats       = None
+  login_form  = re.compile(r'<form\b[^>]*\baction\s*=\s*["\']?'
+                           r'(?:/atrweb/)?Default\.asp\?Action=Login', re.I)
   
-  def __init__(self, username, password, host, employee_id, ssl=False):
+  def __init__(self, username, password, host, employee_id, ssl=False,
+               pool_size=4, idle_timeout=30, cookie_file=None, pool=None):
     '''
-    __init__(username, password, host, employee_id, ssl=False)
+    __init__(username, password, host, employee_id, ssl=False, pool_size=4,
+             idle_timeout=30, cookie_file=None, pool=None)
     Initializes the TimeCardAPI object.  Most of the fields should be self
     explanatory however ther employee_id is derrived form the sel_names
     variable found in the URL of some pages.  find this number and we will
-    use that.
+    use that.  pool_size and idle_timeout control the keep-alive connection
+    pool that all of the requests are sent through.  If a cookie_file is
+    given, the session cookie is saved there and reused by later runs until
+    ATRWeb tells us that the session has expired.  Several TimeCardAPI
+    objects for the same host can share one ConnectionPool by passing it as
+    pool, since the session cookie is sent with each request.
     '''
     self.username     = username
     self.password     = password
     self.host         = host
     self.employee_id  = employee_id
-    if ssl:
-      self.con        = httplib.HTTPSConnection
-    else:
-      self.con        = httplib.HTTPConnection
+    self.cookie_file  = cookie_file
+    self.pool         = pool or ConnectionPool(host, ssl, pool_size, 
+                                               idle_timeout)
+    self.lock         = threading.Lock()
   
   def _set_cookie(self, resp):
     '''
@@ -160,110 +797,228 @@ class TimeCardAPI(object):
     cookie += '; Language=; Languages=; Remember%5Fme=; Password=; Login=;'
     self.cookie = cookie
   
-  def _post(self, url, payload, cookie_update=False):
+  def _load_cookie(self):
+    '''
+    Private Function:  Reads the saved session cookie, if there is one.
+    '''
+    if self.cookie_file is not None and os.path.exists(self.cookie_file):
+      cookie = open(self.cookie_file).read().strip()
+      if cookie != '':
+        self.cookie = cookie
+  
+  def _save_cookie(self):
+    '''
+    Private Function:  Saves the session cookie so that the next run can
+    reuse the session instead of logging in again.
+    '''
+    if self.cookie_file is not None:
+      fd = os.open(self.cookie_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+      os.write(fd, self.cookie)
+      os.close(fd)
+  
+  def _expired(self, resp, data):
+    '''
+    Private Function:  Returns True if the response is ATRWeb bouncing us back
+    to the login page, which is what happens once the session has expired.
+    That is either a redirect to Default.asp or the login form itself.  A
+    page that only links to the login page doesn't count.
+    '''
+    location = resp.getheader('location') or ''
+    if resp.status in (301, 302, 303) and 'default.asp' in location.lower():
+      return True
+    return resp.status == 200 and self.login_form.search(data) is not None
+  
+  def _request(self, method, url, body=None, headers={}, session=True,
+               parser=None):
+    '''
+    Private Function:  Sends a request with the session cookie and returns the
+    response and the response body.  Unless session is False, we will log in
+    first if we do not have a session yet, and log in again and resend the
+    request if the session that we had has expired.  See ConnectionPool for
+    what happens when a parser is given.
+    '''
+    if session:
+      self.connect()
+    retry = session
+    while True:
+      cookie              = self.cookie
+      headers             = dict(headers)
+      headers['Cookie']   = cookie
+      if self.stats is None:
+        resp, data = self.pool.request(method, url, body, headers, parser)
+      else:
+        started     = time.time()
+        resp, data  = self.pool.request(method, url, body, headers, parser)
+        self.stats.http(time.time() - started, len(body or ''),
+                        int(resp.getheader('content-length') or len(data)))
+      if resp.status >= 400:
+        raise ATRError('%s %s returned %s %s' % (method, url, resp.status,
+                                                 resp.reason))
+      if session and self._expired(resp, data):
+        if not retry:
+          raise ATRError('%s %s was sent back to the login page after '
+                         'logging in again' % (method, url))
+        # Only one thread needs to log back in.  Everyone else will see that
+        # the cookie has already been replaced and just send again.
+        with self.lock:
+          if self.cookie == cookie:
+            self.login()
+        retry = False
+        continue
+      return resp, data
+  
+  def _parse(self, data):
+    '''
+    Private Function:  Parses the page with BeautifulSoup.
+    '''
+    from BeautifulSoup import BeautifulSoup as bsoup
+    if self.stats is None:
+      return bsoup(data)
+    started = time.time()
+    page    = bsoup(data)
+    self.stats.parse(time.time() - started)
+    return page
+  
+  def _post(self, url, payload, cookie_update=False, parse=True, 
+            session=True):
     '''
-    General HTTP post function.  Requires a url and a payload.
+    General HTTP post function.  Requires a url and a payload.  If parse is
+    False the response object is returned instead of the parsed page.
     '''
+    import urllib
     body    = urllib.urlencode(payload)
     headers = {
-            'Cookie': self.cookie,
     'Content-Length': len(body),
       'Content-Type': 'application/x-www-form-urlencoded'
     }
-    http    = self.con(self.host)
-    http.request('POST', url, body, headers)
-    resp    = http.getresponse()
-    page    = bsoup(resp.read())
+    resp, data = self._request('POST', url, body, headers, session)
     if cookie_update:
       self._set_cookie(resp)
-    return page
+    if not parse:
+      return resp
+    return self._parse(data)
   
-  def _get(self, url, cookie_update=False):
+  def _get(self, url, cookie_update=False, parse=True, session=True,
+           parser=None):
     '''
-    General HTTP Get function.  Requires a URL.
+    General HTTP Get function.  Requires a URL.  If a parser is given, the page
+    is streamed through it and the parser is returned, if parse is False the
+    response object is returned, otherwise the page is parsed with
+    BeautifulSoup.
     '''
     if cookie_update:
       self.cookie = ''
-    headers = {'Cookie': self.cookie,}
-    http    = self.con(self.host)
-    http.request('GET', url, headers=headers)
-    resp    = http.getresponse()
-    page    = bsoup(resp.read())
+      session     = False
+    resp, data = self._request('GET', url, session=session, parser=parser)
     if cookie_update:
       self._set_cookie(resp)
-    return page
+    if parser is not None:
+      charset = re.search(r'charset=([\w-]+)', 
+                          resp.getheader('content-type') or '')
+      if charset is not None:
+        parser.encoding = charset.group(1)
+      return parser
+    if not parse:
+      return resp
+    return self._parse(data)
+  
+  def connect(self):
+    '''
+    Makes sure that we have a session cookie to work with.  A saved cookie
+    from an earlier run is used if we have one, otherwise we will log in.
+    '''
+    if self.cookie is None:
+      self._load_cookie()
+    if self.cookie is None:
+      with self.lock:
+        if self.cookie is None:
+          self.login()
   
   def login(self):
     '''
     Runs the series of posts and gets in order to log the user in with the
-    session cookie that we have.
+    session cookie that we have.  Raises an ATRError if ATRWeb sends us back
+    to the login page, in which case the cookie is not saved.
     '''
-    self._get('/atrweb/', cookie_update=True)
-    self._post('/atrweb/Default.asp?Action=Login', {
+    import urllib
+    self._get('/atrweb/', cookie_update=True, parse=False)
+    body    = urllib.urlencode({
          'Login': self.username,
       'Password': self.password,
       'Language': 0,
           'Type': 0,
     })
+    headers = {
+    'Content-Length': len(body),
+      'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    resp, data = self._request('POST', '/atrweb/Default.asp?Action=Login',
+                               body, headers, session=False)
+    if self._expired(resp, data):
+      raise ATRError('ATRWeb did not accept the login for %s' % self.username)
+    self._save_cookie()
   
   def pull_database(self):
     '''
     Pulls down the database entries needed to populate the department,
     project, and task tables.
     '''
-    self.login()
     cur_date  = datetime.datetime.now().strftime('%d/%m/%Y')
-    page      = self._get('/atrweb/DayInfo.asp?adtmDate=%s' % cur_date)
-    db        = {'departments': {}, 'projects': {}}
-    
-    # First thing we need to do is pull the departments.  This is actually the
-    # easier of the tasks at hand as they are stored in a pretty nice and
-    # easy format to parse.
-    deps      = page.find('select', {'name': 'ddl_abbr'})
-    for dep in deps.findChildren():
-      try:
-        val     = int(dep.get('value'))
-        db['departments'][val] = dep.text
-      except:
-        pass
-    
-    # Now for the fun part.  We need to parse some pretty grotesque javascript
-    # in order to pull out the dictionaries that we need to parse. to do this
-    # we need to actually convert the page back to a srting and try to handle
-    # it that way.
-    html  = page.prettify()
-    dpos  = html.find('Np=new Array(')
-    vpos  = html.find('Kp=new Array(')
-    tpos  = html.find('TaskArray = new Array(')
-    dlist = html[dpos:dpos+3000].split('\r')[0].strip('Np=new Array(').strip(');').split('","')
-    vlist = html[vpos:vpos+3000].split('\r')[0].strip('Kp=new Array(').strip(');').split('","')
-    tlist = html[tpos:tpos+10000].split('\n')[0].strip('TaskArray = new Array(').strip('))').split('),new Array(')
-    
-    # Now that we have all the data parsed out (hopefully) we need to try to
-    # peice it back together into something meaningful.  This is some more
-    # nasty hackery and I apologise in advance.
-    for entry in vlist:
-      try:
-        if entry is not 'Error!':
-          val = int(entry.strip('"'))
-          db['projects'][val] = {
-            'tasks': {},
-            'value': dlist[vlist.index(entry)].strip('"')
-          }
-          for item in tlist:
-            dset  = item.split(',')
-            proj  = int(dset[0])
-            name  = dset[1].strip('\'')
-            value = int(dset[2])
-            if proj == val:
-              db['projects'][val]['tasks'][value] = name
-      except ValueError:
-        continue
+    page      = self._get('/atrweb/DayInfo.asp?adtmDate=%s' % cur_date,
+                          parser=DayInfoParser())
+    if self.stats is None:
+      return page.catalogue()
+    started   = time.time()
+    db        = page.catalogue()
+    self.stats.parse(time.time() - started)
     return db
   
-  def add(self, entry):
+  def day_entries(self, date):
+    '''
+    day_entries(date)
+    Pulls down the DayInfo.asp page for the date and returns the entries that
+    ATRWeb has for it (see DayEntriesParser.entries).
+    '''
+    page  = self._get('/atrweb/DayInfo.asp?adtmDate=%s&sel_names=%s' %\
+                      (date.strftime('%d/%m/%Y'), self.employee_id),
+                      parser=DayEntriesParser())
+    return page.entries()
+  
+  def day_entries_many(self, dates, workers=4):
+    '''
+    day_entries_many(dates, workers=4)
+    Pulls down the entries for each of the dates, fetching up to workers
+    pages at the same time.  Returns a list of (date, entries, error) tuples
+    in the same order as the dates were given.  entries will be None for
+    every date that could not be fetched.
     '''
-    Adds a TimeEntry object into ATRWeb.
+    jobs    = Queue.Queue()
+    results = [None] * len(dates)
+    for idx, date in enumerate(dates):
+      jobs.put((idx, date))
+    
+    def worker():
+      while True:
+        try:
+          idx, date = jobs.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          results[idx] = (date, self.day_entries(date), None)
+        except Exception, error:
+          results[idx] = (date, None, error)
+    
+    threads = [threading.Thread(target=worker) 
+               for i in range(max(1, min(workers, len(dates))))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results
+  
+  def _payload(self, entry):
+    '''
+    Private Function:  Builds the operate.asp form payload for a TimeEntry.
     '''
     payload = {
        'selected_row': '',
@@ -273,8 +1028,8 @@ class TimeCardAPI(object):
     'int_employee_id': self.employee_id,
            'dtm_date': entry.date.strftime('%m/%d/%Y'),
               'notes': '',
-           'ddl_abbr': entry.department.id,
-        'ddl_project': entry.project.id,
+           'ddl_abbr': entry.department_id,
+        'ddl_project': entry.project_id,
         'date_from_f': entry.date.strftime('%m/%d/%Y'),
            'dtm_from': entry.start_time.strftime('%H:%M'),
           'date_to_f': entry.date.strftime('%m/%d/%Y'),
@@ -287,15 +1042,279 @@ class TimeCardAPI(object):
                'link': 1,
     }
     if entry.task_id is not None:
-      payload['tasks'] = entry.task.id
-    self._post('/atrweb/operate.asp', payload)
+      payload['tasks'] = entry.task_id
+    return payload
+  
+  def add(self, entry):
+    '''
+    Adds a TimeEntry object into ATRWeb.  Returns the status line that
+    ATRWeb responded with.
+    '''
+    resp = self._post('/atrweb/operate.asp', self._payload(entry), parse=False)
+    return '%s %s' % (resp.status, resp.reason)
+  
+  def add_many(self, entries, workers=4):
+    '''
+    add_many(entries, workers=4)
+    Adds a list of TimeEntry objects into ATRWeb, sending up to workers
+    entries at the same time over the shared session cookie.  Returns a list
+    of (entry, response, error) tuples in the same order as the entries were
+    given.  error will be None for every entry that was pushed successfully.
+    '''
+    # The payloads are all built up front here so that the worker threads
+    # never have to touch the SQLAlchemy objects themselves.
+    jobs    = Queue.Queue()
+    results = [None] * len(entries)
+    for idx, entry in enumerate(entries):
+      jobs.put((idx, entry, self._payload(entry)))
+    
+    def worker():
+      while True:
+        try:
+          idx, entry, payload = jobs.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          resp = self._post('/atrweb/operate.asp', payload, parse=False)
+          results[idx] = (entry, '%s %s' % (resp.status, resp.reason), None)
+        except Exception, error:
+          results[idx] = (entry, None, error)
+    
+    threads = [threading.Thread(target=worker) 
+               for i in range(max(1, min(workers, len(entries))))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results
 
-class TimeCardCLI(cmd.Cmd):
-  config  = ConfigParser()
-  intro   = motd
+class Catalogue(object):
+  '''
+  A compact in-memory copy of the catalogue.  The department, project, and
+  task names are kept by id so that the commands can look them up without
+  going back to the database, and for tab completion everything is also
+  kept as sorted lists of strings so that a completion is just a binary
+  search for the prefix, no matter how large the catalogue is.
+  '''
+  def __init__(self, engine):
+    '''
+    __init__(engine)
+    Loads the catalogue from the database with one query per table.
+    '''
+    conn              = engine.connect()
+    self.department_names = dict([(r[0], r[1]) for r in conn.execute(
+                              select([Department.__table__.c.id,
+                                      Department.__table__.c.name]))])
+    self.project_names    = dict([(r[0], r[1]) for r in conn.execute(
+                              select([Project.__table__.c.id,
+                                      Project.__table__.c.name]))])
+    self.task_names       = {}
+    self.task_projects    = {}
+    self.templates    = sorted([r[0] for r in conn.execute(
+                          select([Template.__table__.c.name])) 
+                          if r[0] is not None])
+    self.tasks        = {}
+    words             = set()
+    for pid, tid, name in conn.execute(select([Task.__table__.c.project_id,
+                                               Task.__table__.c.id,
+                                               Task.__table__.c.name])):
+      self.task_names[tid]    = name
+      self.task_projects[tid] = pid
+      self.tasks.setdefault(str(pid), []).append(str(tid))
+      words.update(re.findall(r'\w+', (name or '').lower(), re.U))
+    conn.close()
+    for names in (self.department_names, self.project_names):
+      for name in names.values():
+        words.update(re.findall(r'\w+', (name or '').lower(), re.U))
+    for name in self.templates:
+      words.update(re.findall(r'\w+', name.lower(), re.U))
+    for tasks in self.tasks.values():
+      tasks.sort()
+    self.departments  = sorted([str(i) for i in self.department_names])
+    self.projects     = sorted([str(i) for i in self.project_names])
+    self.words        = sorted(words)
+  
+  def project_tasks(self, pid):
+    '''
+    project_tasks(pid)
+    Returns the ids of the project's tasks in order.
+    '''
+    return sorted([int(t) for t in self.tasks.get(str(pid), [])])
+  
+  def find(self, names, text):
+    '''
+    find(names, text)
+    Returns the ids in the id to name dictionary whose names contain the
+    text, ignoring case, in order.
+    '''
+    text  = text.lower()
+    return sorted([i for i, name in names.items() 
+                   if text in (name or '').lower()])
+  
+  def complete(self, items, prefix):
+    '''
+    complete(items, prefix)
+    Returns all of the items in the sorted list that start with the prefix.
+    '''
+    matches = []
+    for idx in range(bisect.bisect_left(items, prefix), len(items)):
+      if not items[idx].startswith(prefix):
+        break
+      matches.append(items[idx])
+    return matches
+
+
+class CompiledTemplate(object):
+  '''
+  A template with all of the {FIELD} placeholders in its actions parsed out
+  ahead of time.  Each description and note is split once into a list of
+  literal text and field names, so running the template is just a join, and
+  the fields that the template needs are known before anything is generated.
+  Field names are matched in upper case, just like the -f option stores them.
+  '''
+  placeholder = re.compile(r'\{(\w+)\}')
+  
+  def __init__(self, template):
+    '''
+    __init__(template)
+    Compiles the template and its actions (in stack order).
+    '''
+    self.id       = template.id
+    self.name     = template.name
+    self.fields   = set()
+    self.actions  = []
+    offset        = 0
+    for action in template.actions:
+      self.actions.append({
+        'offset':         offset,
+        'duration':       action.duration,
+        'billable':       action.billable,
+        'department_id':  action.department_id,
+        'project_id':     action.project_id,
+        'task_id':        action.task_id,
+        'description':    self._compile(action.description),
+        'notes':          self._compile(action.notes),
+      })
+      offset += action.duration
+    self.duration = offset
+  
+  def _compile(self, text):
+    '''
+    Private Function:  Splits the text into a list of parts.  The even parts
+    are literal text and the odd parts are field names.
+    '''
+    parts = self.placeholder.split(text or '')
+    for idx in range(1, len(parts), 2):
+      parts[idx] = parts[idx].upper()
+      self.fields.add(parts[idx])
+    return parts
+  
+  def _render(self, parts, values):
+    '''
+    Private Function:  Fills in the field names in the compiled parts.
+    '''
+    if len(parts) == 1:
+      return parts[0]
+    parts     = list(parts)
+    for idx in range(1, len(parts), 2):
+      parts[idx] = values[parts[idx]]
+    return ''.join(parts)
+  
+  def missing(self, values):
+    '''
+    missing(values)
+    Returns a sorted list of the fields the template uses that are not in the
+    values given.
+    '''
+    return sorted(self.fields - set(values))
   
+  def expand(self, start, values):
+    '''
+    expand(start, values)
+    Returns the entry rows (as dictionaries of entry columns) for running the
+    template at the start datetime with the given field values.
+    '''
+    rows    = []
+    for action in self.actions:
+      began = start + datetime.timedelta(minutes=action['offset'])
+      ended = began + datetime.timedelta(minutes=action['duration'])
+      rows.append({
+        'date':           began.date(),
+        'start_time':     began.time(),
+        'end_time':       ended.time(),
+        'billable':       action['billable'],
+        'department_id':  action['department_id'],
+        'project_id':     action['project_id'],
+        'task_id':        action['task_id'],
+        'description':    self._render(action['description'], values),
+        'notes':          self._render(action['notes'], values),
+      })
+    return rows
+
+
+class IntervalIndex(object):
+  '''
+  The time entries of each day kept as intervals sorted by their start time.
+  Once a day is sorted, one pass over it finds every entry that starts before
+  the latest end seen so far (an overlap) and every stretch of time between
+  that latest end and the next start (a gap), so checking n entries is
+  O(n log n) no matter how they are spread over the days.  Times are kept as
+  minutes past midnight, and an entry that ends before it starts is taken to
+  run past midnight.
+  '''
   def __init__(self):
-    cloc        = os.path.join(sys.path[0], 'config.ini')
+    self.days   = {}
+  
+  def add(self, date, start, end, eid):
+    '''
+    add(date, start, end, eid)
+    Adds the entry's interval to the day.
+    '''
+    start = start.hour * 60 + start.minute
+    end   = end.hour * 60 + end.minute
+    if end < start:
+      end += 24 * 60
+    self.days.setdefault(date, []).append((start, end, eid))
+  
+  def check(self, date, minimum=1):
+    '''
+    check(date, minimum=1)
+    Returns the overlaps and gaps for the day as a list of tuples of the kind
+    ('overlap' or 'gap'), the start and end minutes, and the ids of the
+    entries on either side.  Only gaps of at least minimum minutes are
+    returned.
+    '''
+    problems  = []
+    intervals = sorted(self.days.get(date, []))
+    if len(intervals) == 0:
+      return problems
+    latest, last = intervals[0][1], intervals[0][2]
+    for start, end, eid in intervals[1:]:
+      if start < latest:
+        problems.append(('overlap', start, min(end, latest), last, eid))
+      elif start - latest >= minimum:
+        problems.append(('gap', latest, start, last, eid))
+      if end > latest:
+        latest, last = end, eid
+    return problems
+
+
+class TimeCardCLI(cmd.Cmd):
+  intro     = motd
+  catalogue = None
+  _api      = None
+  
+  def __init__(self, path=None, stats=None):
+    '''
+    __init__(path=None, stats=None)
+    Loads the config file and opens the database in the path, which defaults
+    to the directory that timecard.py is in.  If a Stats object is given, it
+    is reset and printed around every command.
+    '''
+    self.path   = path or sys.path[0]
+    self.stats  = stats
+    self.config = ConfigParser(config_defaults)
+    cloc        = os.path.join(self.path, 'config.ini')
     if not os.path.exists(cloc):
       config = open(cloc, 'w')
       config.write(default_config)
@@ -306,42 +1325,164 @@ class TimeCardCLI(cmd.Cmd):
     self.prompt = 'tc[%s]> ' % self.config.get('ATR', 'username')
     self.dept   = self.config.getint('General', 'default_department')
     
-    sql_string  = 'sqlite:///%s' % os.path.join(sys.path[0],'database.sqlite')
+    sql_string  = 'sqlite:///%s' % os.path.join(self.path, 'database.sqlite')
     self.engine = create_engine(sql_string)
+    self.queries = None
+    if self.config.getboolean('General', 'count_queries'):
+      self.queries = 0
+      event.listen(self.engine, 'before_cursor_execute', self._count_query)
+    if self.stats is not None:
+      event.listen(self.engine, 'before_cursor_execute', self.stats.statement)
+      event.listen(self.engine, 'commit', self.stats.commit)
     self.smaker = sessionmaker(bind=self.engine)
-    Department.metadata.create_all(self.engine)
-    Project.metadata.create_all(self.engine)
-    Task.metadata.create_all(self.engine)
-    Template.metadata.create_all(self.engine)
-    Action.metadata.create_all(self.engine)
-    TimeEntry.metadata.create_all(self.engine)
-    
-    self.api    = TimeCardAPI(self.config.get('ATR', 'username'),
+    self.compiled = {}
+    self.drain_lock = threading.Lock()
+    self.drain_notes = []
+    self.apis = {}
+    self.pools = {}
+    self._migrate()
+    cmd.Cmd.__init__(self)
+  
+  @property
+  def api(self):
+    '''
+    The TimeCardAPI object.  This is only created the first time that a
+    command actually needs to talk to ATRWeb.
+    '''
+    if self._api is None:
+      self._api = TimeCardAPI(self.config.get('ATR', 'username'),
                               self.config.get('ATR', 'password'),
                               self.config.get('ATR', 'host'),
                               self.config.get('ATR', 'employee_id'),
-                              self.config.getboolean('ATR', 'ssl'))
-    cmd.Cmd.__init__(self)
+                              self.config.getboolean('ATR', 'ssl'),
+                              self.config.getint('ATR', 'pool_size'),
+                              self.config.getint('ATR', 'idle_timeout'),
+                              os.path.join(self.path, 'session.cookie'))
+      self._api.stats = self.stats
+    return self._api
+  
+  def _roster(self):
+    '''
+    Private Function:  Returns the sorted names of the employees in the
+    roster.  Each employee has an [Employee NAME] section in the config file.
+    '''
+    return sorted([section[len('Employee '):].strip() 
+                   for section in self.config.sections()
+                   if section.startswith('Employee ')])
+  
+  def _employee(self, s):
+    '''
+    Private Function:  Checks that the name is in the roster.
+    '''
+    if s in self._roster():
+      return True, s
+    return False, 'Invalid Employee.  %s is not in the roster.' % s
+  
+  def _api_for(self, employee):
+    '''
+    Private Function:  Returns the TimeCardAPI for the roster employee, or the
+    main one from the [ATR] section if employee is None.  Each employee gets
+    their own session cookie, but everyone on the same host shares a single
+    connection pool.
+    '''
+    if employee is None:
+      return self.api
+    if employee not in self.apis:
+      section = 'Employee %s' % employee
+      def option(name):
+        if self.config.has_option(section, name):
+          return self.config.get(section, name)
+        return self.config.get('ATR', name)
+      host    = option('host')
+      ssl     = option('ssl').lower() in ('1', 'yes', 'true', 'on')
+      if (host, ssl) not in self.pools:
+        if (host, ssl) == (self.config.get('ATR', 'host'),
+                           self.config.getboolean('ATR', 'ssl')):
+          self.pools[(host, ssl)] = self.api.pool
+        else:
+          self.pools[(host, ssl)] = ConnectionPool(host, ssl,
+                                      self.config.getint('ATR', 'pool_size'),
+                                      self.config.getint('ATR', 'idle_timeout'))
+      cookie  = os.path.join(self.path, 'session-%s.cookie' % employee)
+      api     = TimeCardAPI(self.config.get(section, 'username'),
+                            self.config.get(section, 'password'), host,
+                            option('employee_id'), ssl, cookie_file=cookie,
+                            pool=self.pools[(host, ssl)])
+      api.stats = self.stats
+      self.apis[employee] = api
+    return self.apis[employee]
+  
+  def _migrate(self):
+    '''
+    Private Function:  Creates the schema and runs any of the migrations that
+    the database has not had applied yet.  If the database is already at the
+    current version, all this costs is the pragma query.
+    '''
+    with self.engine.begin() as conn:
+      version   = conn.execute('PRAGMA user_version').scalar()
+      if version < len(migrations):
+        Base.metadata.create_all(conn)
+        for idx in range(version, len(migrations)):
+          if callable(migrations[idx]):
+            migrations[idx](conn)
+            continue
+          for statement in migrations[idx]:
+            conn.execute(statement)
+        conn.execute('PRAGMA user_version = %d' % len(migrations))
+      self.fts  = conn.execute("SELECT count(*) FROM sqlite_master "
+                               "WHERE name = 'search'").scalar() > 0
+      # If sqlite didn't have FTS5 when the index migration ran, we try again
+      # every time, so the index gets built once sqlite has been upgraded.
+      # Without FTS5 this only costs the one failed statement.
+      if not self.fts:
+        self.fts = search_index(conn)
+  
+  def _count_query(self, *args):
+    '''
+    Private Function:  SQLAlchemy event hook that counts the statements run.
+    '''
+    self.queries += 1
+  
+  def onecmd(self, s):
+    '''
+    Runs the command, then prints how many SQL statements it took if
+    count_queries has been enabled, and the stats if they are being kept.
+    '''
+    if (self.queries is None and self.stats is None) or s.strip() == '':
+      return cmd.Cmd.onecmd(self, s)
+    if self.queries is not None:
+      self.queries = 0
+    if self.stats is not None:
+      self.stats.reset()
+    try:
+      return cmd.Cmd.onecmd(self, s)
+    finally:
+      if self.queries is not None:
+        print '(%d SQL statements)' % self.queries
+      if self.stats is not None:
+        print self.stats.report()
   
-  def _print_department(self, department):
+  def _print_department(self, did):
     '''
     Private Function:  Prints a department to the screen.
     '''
-    print 'D: [%3d] %s' % (department.id, department.name)
+    print 'D: [%3d] %s' % (did, self._catalogue().department_names[did])
   
-  def _print_project(self, project):
+  def _print_project(self, pid):
     '''
     Private Function:  Prints a project and all associated tasks to the screen.
     '''
-    print 'P: [%3d] %s' % (project.id, project.name)
-    for task in project.tasks:
-      self._print_task(task)
+    cat = self._catalogue()
+    print 'P: [%3d] %s' % (pid, cat.project_names[pid])
+    for tid in cat.project_tasks(pid):
+      self._print_task(tid)
   
-  def _print_task(self, task):
+  def _print_task(self, tid):
     '''
     Private Function:  Prints a task to the screen.
     '''
-    print '\t[%3d %3d] %s' % (task.project.id, task.id, task.name)
+    cat = self._catalogue()
+    print '\t[%3d %3d] %s' % (cat.task_projects[tid], tid, cat.task_names[tid])
   
   def _print_template(self, template):
     '''
@@ -351,8 +1492,8 @@ class TimeCardCLI(cmd.Cmd):
                                  template.description)
     for action in template.actions:
       print '\t[%3d] %s %s %s %s %s\n\t\t Notes: %s' %\
-            (action.id, action.duration, action.department.id, 
-             action.project.id, action.task.id, action.description, 
+            (action.id, action.duration, action.department_id, 
+             action.project_id, action.task_id, action.description, 
              action.notes)
   
   def _date(self, s):
@@ -376,6 +1517,397 @@ class TimeCardCLI(cmd.Cmd):
      return False, 'Invalid Argument.  Must be an integer.'
       
   
+  def _check(self, start, end, minimum=1, employee=None):
+    '''
+    Private Function:  Loads the employee's entries between the dates into an
+    interval index and returns the number of entries and the list of (date,
+    problem) tuples for every overlap and gap.
+    '''
+    entry   = TimeEntry.__table__
+    index   = IntervalIndex()
+    count   = 0
+    conn    = self.engine.connect()
+    for eid, date, began, ended in conn.execute(select([entry.c.id, 
+                      entry.c.date, entry.c.start_time, entry.c.end_time])\
+                      .where(and_(entry.c.date >= start, 
+                                  entry.c.date <= end,
+                                  entry.c.employee == employee))):
+      index.add(date, began, ended, eid)
+      count += 1
+    conn.close()
+    problems = []
+    for date in sorted(index.days.keys()):
+      problems.extend([(date, p) for p in index.check(date, minimum)])
+    return count, problems
+  
+  def _print_problem(self, date, problem):
+    '''
+    Private Function:  Prints an overlap or gap found by _check.
+    '''
+    kind, start, end, before, after = problem
+    span = '%02d:%02d-%02d:%02d' % (start // 60 % 24, start % 60, 
+                                    end // 60 % 24, end % 60)
+    if kind == 'overlap':
+      print '%s OVERLAP %s entries %s and %s' %\
+            (date.strftime('%Y-%m-%d'), span, before, after)
+    else:
+      print '%s GAP     %s %d minutes between entries %s and %s' %\
+            (date.strftime('%Y-%m-%d'), span, end - start, before, after)
+  
+  def _warn_overlaps(self, start, end, employee=None):
+    '''
+    Private Function:  Prints a warning for every overlap between the dates.
+    This is used after entries are added, where gaps are expected.
+    '''
+    count, problems = self._check(start, end, 1, employee)
+    for date, problem in problems:
+      if problem[0] == 'overlap':
+        print 'WARNING:',
+        self._print_problem(date, problem)
+  
+  def _unpushed(self, session, entries, digests):
+    '''
+    Private Function:  Checks the push ledger and returns the entries that
+    are new or have changed since they were last pushed.  digests is the
+    dictionary of entry id to TimeEntry.digest().
+    '''
+    if len(entries) == 0:
+      return entries
+    pushed  = dict(session.query(PushRecord.entry_id, PushRecord.digest)\
+                .filter(PushRecord.entry_id.in_(digests.keys())).all())
+    return [item for item in entries if pushed.get(item.id) != digests[item.id]]
+  
+  def _record(self, session, results, digests, verbose=False):
+    '''
+    Private Function:  Records the (entry, response, error) results from
+    TimeCardAPI.add_many in the push ledger.  The entries that went up are
+    taken out of the outbox and the ones that failed are queued in it to be
+    retried.  Returns the ids of the entries that failed.
+    '''
+    sent    = []
+    failed  = []
+    for item, response, error in results:
+      if error is None:
+        record          = PushRecord()
+        record.entry_id = item.id
+        record.pushed   = datetime.datetime.now()
+        record.digest   = digests[item.id]
+        record.response = response
+        session.merge(record)
+        sent.append(item.id)
+        if verbose:
+          print 'Pushed Entry Number %s' % item.id
+      else:
+        failed.append(item.id)
+        if verbose:
+          print 'FAILED Entry Number %s: %s' % (item.id, error)
+    if len(sent) > 0:
+      session.query(Outbox).filter(Outbox.entry_id.in_(sent))\
+             .delete(synchronize_session=False)
+    if len(failed) > 0:
+      self._enqueue(session.connection(), failed)
+    return failed
+  
+  def _enqueue(self, conn, ids):
+    '''
+    Private Function:  Puts the entries into the outbox to be sent by drain.
+    ids is a list of entry ids or a select that returns them.  Entries that
+    are already queued are queued again to be tried right away.  Returns the
+    number of entries queued.
+    '''
+    if not isinstance(ids, list):
+      ids = [r[0] for r in conn.execute(ids)]
+    now = datetime.datetime.now()
+    if len(ids) > 0:
+      conn.execute(Outbox.__table__.insert().prefix_with('OR REPLACE'), 
+                   [{'entry_id': eid, 'queued': now, 'attempts': 0,
+                     'next_try': now, 'last_error': None} for eid in ids])
+    return len(ids)
+  
+  def _backoff(self, item, error):
+    '''
+    Private Function:  Records a failed attempt for the outbox item and works
+    out when it should next be tried.
+    '''
+    delay           = min(self.config.getint('ATR', 'retry_base') *\
+                          2 ** (item.attempts or 0),
+                          self.config.getint('ATR', 'retry_max'))
+    item.attempts   = (item.attempts or 0) + 1
+    item.next_try   = datetime.datetime.now() +\
+                      datetime.timedelta(seconds=delay)
+    item.last_error = str(error)
+  
+  def _drain(self, due=True, workers=None):
+    '''
+    Private Function:  Sends the entries in the outbox to ATRWeb.  If due is
+    True, only the entries whose retry time has come are sent.  The outbox is
+    worked through in batches and every batch is committed as it finishes, so
+    if we crash partway through, only the batch in flight is sent again the
+    next time.  Returns the number of entries sent, failed, and skipped
+    (because the same entry had already been pushed).
+    '''
+    if workers is None:
+      workers = self.config.getint('ATR', 'push_workers')
+    sent    = 0
+    failed  = 0
+    skipped = 0
+    with self.drain_lock:
+      session = self.smaker()
+      query   = session.query(TimeEntry, Outbox)\
+                       .join(Outbox, Outbox.entry_id == TimeEntry.id)
+      if due:
+        query = query.filter(Outbox.next_try <= datetime.datetime.now())
+      items   = query.order_by(Outbox.queued, TimeEntry.id).all()
+      
+      # Anything that has already been pushed as it is now (by push, or by
+      # an earlier drain that crashed before it got to clear the outbox) is
+      # dropped rather than sent twice.
+      digests = dict([(entry.id, entry.digest()) for entry, item in items])
+      keep    = set([e.id for e in self._unpushed(session, 
+                                  [entry for entry, item in items], digests)])
+      for entry, item in items:
+        if entry.id not in keep:
+          session.delete(item)
+          skipped += 1
+      items   = [(entry, item) for entry, item in items if entry.id in keep]
+      
+      # Every employee's entries go up through their own session.
+      employees = {}
+      for entry, item in items:
+        employees.setdefault(entry.employee, []).append((entry, item))
+      for employee in sorted(employees.keys()):
+        items = employees[employee]
+        api   = self._api_for(employee)
+        try:
+          api.connect()
+        except Exception, error:
+          for entry, item in items:
+            self._backoff(item, error)
+          failed += len(items)
+          continue
+        size = max(workers, 1) * 4
+        for idx in range(0, len(items), size):
+          batch   = items[idx:idx + size]
+          results = api.add_many([entry for entry, item in batch], workers)
+          for (entry, item), (e, response, error) in zip(batch, results):
+            if error is None:
+              record          = PushRecord()
+              record.entry_id = entry.id
+              record.pushed   = datetime.datetime.now()
+              record.digest   = digests[entry.id]
+              record.response = response
+              session.merge(record)
+              session.delete(item)
+              sent += 1
+            else:
+              self._backoff(item, error)
+              failed += 1
+          session.commit()
+      session.commit()
+      session.close()
+    return sent, failed, skipped
+  
+  def _drainer(self):
+    '''
+    Private Function:  The background thread that drains the outbox while the
+    interactive prompt is open.  It never prints, the results are picked up
+    by precmd and shown before the next command.
+    '''
+    interval = self.config.getint('ATR', 'drain_interval')
+    while True:
+      time.sleep(interval)
+      try:
+        sent, failed, skipped = self._drain()
+      except Exception, error:
+        self.drain_notes.append('Outbox: drain failed: %s' % error)
+        continue
+      if sent > 0 or failed > 0:
+        self.drain_notes.append('Outbox: sent %d entries, %d failed.' %\
+                                (sent, failed))
+  
+  def preloop(self):
+    '''
+    Starts the background outbox drain for the interactive prompt.
+    '''
+    if self.config.getint('ATR', 'drain_interval') > 0:
+      thread        = threading.Thread(target=self._drainer)
+      thread.daemon = True
+      thread.start()
+  
+  def precmd(self, line):
+    '''
+    Prints anything that the background drain has to report.
+    '''
+    while len(self.drain_notes) > 0:
+      print self.drain_notes.pop(0)
+    return line
+  
+  def _in_use(self, conn, column):
+    '''
+    Private Function:  Returns the set of ids in the given column that are
+    referenced by any of the local entries or template actions.
+    '''
+    used = set()
+    for table in (TimeEntry.__table__, Action.__table__):
+      used.update([r[0] for r in conn.execute(
+                    select([table.c[column]]).distinct())])
+    return used
+  
+  def _digest(self, values):
+    '''
+    Private Function:  Returns a hash of a list of values.
+    '''
+    return hashlib.sha1(repr(values)).hexdigest()
+  
+  def _reindex(self, conn, kind, added=[], updated=[], removed=[]):
+    '''
+    Private Function:  Applies the changes that _sync made to a table (or any
+    changes in the same form) to the search index.
+    '''
+    if not self.fts:
+      return
+    code    = search_kinds.index(kind)
+    deletes = [(i * 4 + code,) for i, o, r in updated] +\
+              [(i * 4 + code,) for i, o in removed]
+    inserts = [(i * 4 + code, r['name'], r.get('description'), 
+                r.get('project_id')) for i, r in added] +\
+              [(i * 4 + code, r['name'], r.get('description'), 
+                r.get('project_id')) for i, o, r in updated]
+    if len(deletes) > 0:
+      conn.execute('DELETE FROM search WHERE rowid = ?', deletes)
+    if len(inserts) > 0:
+      conn.execute('INSERT INTO search (rowid, name, description, parent) '
+                   'VALUES (?, ?, ?, ?)', inserts)
+  
+  def _sync(self, conn, table, rows, keep=set(), scopes=None):
+    '''
+    Private Function:  Brings a catalogue table in line with the rows given
+    ({id: {column: value}}).  The existing rows are loaded up front and the
+    differences are written with bulk insert, update, and delete statements.
+    If a list of scopes is given, only the existing rows that match one of
+    them are looked at (one query per scope), so the rows given have to
+    cover everything that the scopes match.  Rows in the keep set are never
+    removed.  Returns lists of the (id, row) added, (id, old, row) updated,
+    and (id, old) removed.
+    '''
+    columns = [c.name for c in table.columns if c.name != 'id']
+    current = {}
+    for scope in [None] if scopes is None else scopes:
+      query = select([table])
+      if scope is not None:
+        query = query.where(scope)
+      current.update([(r['id'], dict(r)) for r in conn.execute(query)])
+    added   = [(i, rows[i]) for i in rows if i not in current]
+    updated = [(i, current[i], rows[i]) for i in rows if i in current 
+               and [rows[i][c] for c in columns] != 
+                   [current[i][c] for c in columns]]
+    removed = [(i, current[i]) for i in current 
+               if i not in rows and i not in keep]
+    if len(added) > 0:
+      conn.execute(table.insert(), [dict(r, id=i) for i, r in added])
+    if len(updated) > 0:
+      conn.execute(table.update().where(table.c.id == bindparam('_id'))\
+                   .values(dict([(c, bindparam(c)) for c in columns])),
+                   [dict(r, _id=i) for i, o, r in updated])
+    if len(removed) > 0:
+      conn.execute(table.delete().where(table.c.id == bindparam('_id')),
+                   [{'_id': i} for i, o in removed])
+    return added, updated, removed
+  
+  def _catalogue(self):
+    '''
+    Private Function:  Returns the catalogue cache, loading it if needed.
+    '''
+    if self.catalogue is None:
+      self.catalogue = Catalogue(self.engine)
+    return self.catalogue
+  
+  def _template(self, session, name):
+    '''
+    Private Function:  Returns the compiled template by that name, compiling
+    and caching it if needed.  Returns None if there is no such template.
+    '''
+    if name not in self.compiled:
+      try:
+        template = session.query(Template).options(subqueryload('actions'))\
+                          .filter_by(name=name).one()
+      except:
+        return None
+      self.compiled[name] = CompiledTemplate(template)
+    return self.compiled[name]
+  
+  def _position(self, line, begidx, takes=()):
+    '''
+    Private Function:  Works out what is being completed.  Returns the option
+    that the word belongs to (if it is an option's value) and the list of the
+    positional arguments that come before it.  takes is the list of options
+    that take a value.
+    '''
+    option  = None
+    args    = []
+    for word in line[:begidx].split()[1:]:
+      if option is not None:
+        option = None
+      elif word.startswith('-'):
+        if word in takes:
+          option = word
+      else:
+        args.append(word)
+    return option, args
+  
+  def complete_add(self, text, line, begidx, endidx):
+    cat           = self._catalogue()
+    option, args  = self._position(line, begidx, ('-d', '--date', 
+                                                  '-D', '--dept'))
+    if option in ('-D', '--dept'):
+      return cat.complete(cat.departments, text)
+    if option is None and len(args) == 2:
+      return cat.complete(cat.projects, text)
+    if option is None and len(args) == 3:
+      return cat.complete(cat.tasks.get(args[2], []) + ['none'], text)
+    return []
+  
+  def complete_run(self, text, line, begidx, endidx):
+    cat           = self._catalogue()
+    option, args  = self._position(line, begidx, ('-d', '--date',
+                                                  '-e', '--end',
+                                                  '-f', '--field'))
+    if option is None and len(args) == 0:
+      return cat.complete(cat.templates, text)
+    return []
+  
+  def complete_sched_new(self, text, line, begidx, endidx):
+    cat           = self._catalogue()
+    option, args  = self._position(line, begidx, ('-s', '--start',
+                                                  '-f', '--field'))
+    if option is None and len(args) == 0:
+      return cat.complete(cat.templates, text)
+    return []
+  
+  def complete_search(self, text, line, begidx, endidx):
+    cat           = self._catalogue()
+    option, args  = self._position(line, begidx, ('-n', '--limit'))
+    if option is None:
+      return cat.complete(cat.words, text.lower())
+    return []
+  
+  def complete_tmpl_show(self, text, line, begidx, endidx):
+    cat           = self._catalogue()
+    return cat.complete(cat.templates, text)
+  
+  def complete_tmpl_add(self, text, line, begidx, endidx):
+    cat           = self._catalogue()
+    option, args  = self._position(line, begidx)
+    if len(args) == 0:
+      return cat.complete(cat.templates, text)
+    if len(args) == 3:
+      return cat.complete(cat.departments, text)
+    if len(args) == 4:
+      return cat.complete(cat.projects, text)
+    if len(args) == 5:
+      return cat.complete(cat.tasks.get(args[4], []), text)
+    return []
+  
   def do_add(self, s):
     '''add [OPTIONS] [starttime] [endtime] [projectId] [taskId] [description]
     Adds an entry into the local timecard database.
@@ -385,18 +1917,29 @@ class TimeCardCLI(cmd.Cmd):
      -b (--billable)          Sets the billable flag to true.
      -D (--dept)              Overrides the default department with the
                               department id specified.
+     -q (--queue)             Queues the entry in the outbox to be sent to
+                              ATRWeb.
+     -E (--employee) [NAME]   Adds the entry for the roster employee.
     '''
     entry               = TimeEntry()
     date                = datetime.date.today()
     entry.department_id = self.dept
     entry.billable      = False
+    queue               = False
+    employee            = None
     
     # First thing we need to see if there are any optional arguments in the
     # line and parse those first.  If there are any we will override the
     # default settings that have already been specified.
-    opts, args  = getopt.getopt(s.split(), 'd:bD:', 
-                  ['date=', 'billable', 'dept='])
+    opts, args  = getopt.getopt(s.split(), 'd:bD:qE:', 
+                  ['date=', 'billable', 'dept=', 'queue', 'employee='])
     for opt, val in opts:
+      if opt in ('-E', '--employee'):
+        code, employee = self._employee(val)
+        if not code: print employee; return
+        entry.employee = employee
+      if opt in ('-q', '--queue'):
+        queue = True
       if opt in ('-d', '--date'):
         code, date = self._date(val)
         if not code: print date; return
@@ -431,79 +1974,462 @@ class TimeCardCLI(cmd.Cmd):
         print 'Invalid Project id.  Must be integer.'
         return
       try:
-        if args[3] != 'none':
-          entry.task_id     = int(args[3])
-      except:
-        print 'Invalid Task id.  Must be ineteger.'
+        if args[3] != 'none':
+          entry.task_id     = int(args[3])
+      except:
+        print 'Invalid Task id.  Must be ineteger.'
+        return
+      # The ids are checked against the catalogue cache before we ask for
+      # anything else, so a typo doesn't cost the user their description.
+      cat = self._catalogue()
+      if entry.project_id not in cat.project_names:
+        print 'Unknown Project id %d.  Try update?' % entry.project_id
+        return
+      if entry.task_id is not None and\
+         cat.task_projects.get(entry.task_id) != entry.project_id:
+        print 'Task %d is not a task of project %d.' % (entry.task_id, 
+                                                        entry.project_id)
+        return
+      if len(args) > 4:
+        entry.description = ' '.join(args[4:])
+      else:
+        entry.description = raw_input('Enter Description : ')
+      entry.notes         = raw_input('      Enter Notes : ')
+      
+      #try:
+      session = self.smaker()
+      session.add(entry)
+      session.flush()
+      if queue:
+        self._enqueue(session.connection(), [entry.id])
+      session.commit()
+      session.close()
+      self._warn_overlaps(date, date, employee)
+      #except:
+      #  print 'Could not add the data into the database.  please check to\n'+\
+      #        'make there that there are no issues with the data provided.'
+    else:
+      print 'Not enough arguments.'
+  
+  def _import_rows(self, source, fmt):
+    '''
+    Private Function:  Generator that yields the (line number, row) for each
+    entry in a CSV or JSON Lines stream.  Rows that can't be read at all are
+    yielded as (line number, error message).
+    '''
+    if fmt == 'csv':
+      import csv
+      reader = csv.DictReader(source)
+      for row in reader:
+        yield reader.line_num, dict([((k or '').strip().lower(), v) 
+                                     for k, v in row.items()])
+    else:
+      import json
+      for lineno, line in enumerate(source, 1):
+        if line.strip() == '':
+          continue
+        try:
+          row = json.loads(line)
+        except ValueError, error:
+          yield lineno, 'Invalid JSON: %s' % error
+          continue
+        if not isinstance(row, dict):
+          yield lineno, 'Invalid JSON: Each line must be an object.'
+          continue
+        yield lineno, dict([(k.lower(), v) for k, v in row.items()])
+  
+  def _import_entry(self, row):
+    '''
+    Private Function:  Turns an import row into the values for an entry row.
+    Returns (True, values) or (False, error message).
+    '''
+    def text(name):
+      value = row.get(name)
+      if value is None:
+        return ''
+      if isinstance(value, str):
+        value = value.decode('utf-8')
+      return unicode(value).strip()
+    
+    values  = {}
+    for name, parse in (('date', self._date), ('start', self._time),
+                        ('end', self._time)):
+      code, value = parse(text(name))
+      if not code:
+        return False, '%s: %s' % (name, value)
+      values[name] = value
+    entry = {
+      'date':           values['date'],
+      'start_time':     values['start'],
+      'end_time':       values['end'],
+      'billable':       text('billable').lower() in ('1', 'true', 'yes', 'x'),
+      'department_id':  self.dept,
+      'task_id':        None,
+      'description':    text('description'),
+      'notes':          text('notes'),
+      'employee':       text('employee') or None,
+    }
+    if entry['employee'] is not None:
+      code, value = self._employee(entry['employee'])
+      if not code:
+        return False, 'employee: %s' % value
+    for name, column in (('department', 'department_id'), 
+                         ('project', 'project_id'), ('task', 'task_id')):
+      if text(name) in ('', 'none') and name != 'project':
+        continue
+      code, value = self._int(text(name))
+      if not code:
+        return False, '%s: %s' % (name, value)
+      entry[column] = value
+    return True, entry
+  
+  def do_import(self, s):
+    '''import [OPTIONS] [FILE]
+    Imports entries from a CSV or JSON Lines file, or from stdin if no file
+    (or -) is given.  Each entry needs a date (YYYY-MM-DD), start and end
+    (HH:MM), and project, and can also have a department, task, billable,
+    description, notes, and the roster employee it belongs to.  CSV files
+    need a header row naming the columns.  The departments, projects, and
+    tasks are checked against the catalogue, and any rows that are rejected
+    are listed along with their line number.
+    
+     -f (--format) [FORMAT]  Either csv or jsonl.  By default this is worked
+                             out from the file extension (csv for stdin).
+     -b (--batch) [NUM]      The number of entries that are checked and saved
+                             in each transaction.  (Default: 500)
+     -n (--dry-run)          Only checks the entries, nothing is saved.
+    '''
+    fmt     = None
+    batch   = 500
+    dry     = False
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 'f:b:n', 
+                                ['format=', 'batch=', 'dry-run'])
+    for opt, val in opts:
+      if opt in ('-f', '--format'):
+        fmt = val.lower()
+      if opt in ('-b', '--batch'):
+        code, batch = self._int(val)
+        if not code: print batch; return
+      if opt in ('-n', '--dry-run'):
+        dry = True
+    path  = ' '.join(args)
+    if fmt is None:
+      fmt = 'jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'csv'
+    if fmt not in ('csv', 'jsonl'):
+      print 'Invalid Format.  Must be csv or jsonl.'
+      return
+    if path in ('', '-'):
+      source = sys.stdin
+    else:
+      try:
+        source = open(path, 'rU')
+      except IOError, error:
+        print 'Could not open %s: %s' % (path, error)
+        return
+    
+    imported  = 0
+    rejected  = 0
+    rows      = self._import_rows(source, fmt)
+    while True:
+      chunk = []
+      for lineno, row in rows:
+        if isinstance(row, dict):
+          code, row = self._import_entry(row)
+        else:
+          code = False
+        if not code:
+          print 'Line %d: %s' % (lineno, row)
+          rejected += 1
+          continue
+        chunk.append((lineno, row))
+        if len(chunk) >= batch:
+          break
+      if len(chunk) == 0:
+        break
+      
+      # Now we check all of the ids in this chunk against the catalogue with
+      # one query per table, then save whatever passed in one transaction.
+      with self.engine.begin() as conn:
+        known = {}
+        for table, column in ((Department.__table__, 'department_id'),
+                              (Project.__table__, 'project_id')):
+          ids = set([r[column] for l, r in chunk])
+          known[column] = set([r[0] for r in conn.execute(
+                            select([table.c.id]).where(table.c.id.in_(ids)))])
+        table = Task.__table__
+        ids   = set([r['task_id'] for l, r in chunk 
+                     if r['task_id'] is not None])
+        tasks = dict([(r[0], r[1]) for r in conn.execute(
+                  select([table.c.id, table.c.project_id])\
+                  .where(table.c.id.in_(ids)))]) if len(ids) > 0 else {}
+        good  = []
+        for lineno, row in chunk:
+          error = None
+          if row['department_id'] not in known['department_id']:
+            error = 'Unknown department %s' % row['department_id']
+          elif row['project_id'] not in known['project_id']:
+            error = 'Unknown project %s' % row['project_id']
+          elif row['task_id'] is not None and row['task_id'] not in tasks:
+            error = 'Unknown task %s' % row['task_id']
+          elif row['task_id'] is not None and\
+               tasks[row['task_id']] != row['project_id']:
+            error = 'Task %s is not part of project %s' %\
+                    (row['task_id'], row['project_id'])
+          if error is not None:
+            print 'Line %d: %s' % (lineno, error)
+            rejected += 1
+          else:
+            good.append(row)
+        if len(good) > 0 and not dry:
+          conn.execute(TimeEntry.__table__.insert(), good)
+        imported += len(good)
+    
+    if source is not sys.stdin:
+      source.close()
+    print '%s %d entries, rejected %d.' %\
+          (dry and 'Checked' or 'Imported', imported, rejected)
+  
+  def do_export(self, s):
+    '''export [OPTIONS] [FILE]
+    Exports the entries to a CSV, JSON Lines, or Parquet file, or to stdout if
+    no file (or -) is given.  The entries are streamed out of the database in
+    blocks, so exporting years of entries doesn't need any more memory than
+    exporting a day.  The columns use the same names that import expects, so
+    an export can be imported back in.
+    
+     -s (--start) [DATE]     Only exports entries on or after this date.
+     -e (--end) [DATE]       Only exports entries on or before this date.
+     -f (--format) [FORMAT]  One of csv, jsonl, or parquet.  By default this
+                             is worked out from the file extension (csv for
+                             stdout).  Parquet needs pyarrow installed, and
+                             0.16 is the last pyarrow release that runs on
+                             Python 2 (newer ones need Python 3).
+    '''
+    start   = None
+    end     = None
+    fmt     = None
+    block   = 5000
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 's:e:f:', 
+                                ['start=', 'end=', 'format='])
+    for opt, val in opts:
+      if opt in ('-s', '--start'):
+        code, start = self._date(val)
+        if not code: print start; return
+      if opt in ('-e', '--end'):
+        code, end = self._date(val)
+        if not code: print end; return
+      if opt in ('-f', '--format'):
+        fmt = val.lower()
+    path  = ' '.join(args)
+    if fmt is None:
+      fmt = os.path.splitext(path)[1].lower().strip('.') or 'csv'
+      fmt = {'json': 'jsonl', 'pq': 'parquet'}.get(fmt, fmt)
+    if fmt not in ('csv', 'jsonl', 'parquet'):
+      print 'Invalid Format.  Must be csv, jsonl, or parquet.'
+      return
+    if fmt == 'parquet':
+      try:
+        import pyarrow
+        import pyarrow.parquet
+      except ImportError:
+        print 'Exporting to parquet needs pyarrow to be installed (0.16 is '\
+              'the last release for Python 2).'
         return
-      if len(args) > 4:
-        entry.description = ' '.join(args[4:])
-      else:
-        entry.description = raw_input('Enter Description : ')
-      entry.notes         = raw_input('      Enter Notes : ')
-      
-      #try:
-      session = self.smaker()
-      session.add(entry)
-      session.commit()
-      session.close()
-      #except:
-      #  print 'Could not add the data into the database.  please check to\n'+\
-      #        'make there that there are no issues with the data provided.'
+      if path in ('', '-'):
+        print 'Parquet exports need to be written to a file.'
+        return
+    
+    entry   = TimeEntry.__table__
+    dept    = Department.__table__
+    proj    = Project.__table__
+    task    = Task.__table__
+    columns = [
+      ('id', entry.c.id), ('date', entry.c.date),
+      ('start', entry.c.start_time), ('end', entry.c.end_time),
+      ('billable', entry.c.billable),
+      ('department', entry.c.department_id), ('department_name', dept.c.name),
+      ('project', entry.c.project_id), ('project_name', proj.c.name),
+      ('task', entry.c.task_id), ('task_name', task.c.name),
+      ('description', entry.c.description), ('notes', entry.c.notes),
+      ('employee', entry.c.employee),
+    ]
+    names   = [n for n, c in columns]
+    if fmt == 'parquet':
+      # The parquet schema is set from the column types up front.  If pyarrow
+      # worked it out from the first block, a column that happened to be all
+      # empty there would come out as null and the next block wouldn't fit.
+      schema = pyarrow.schema([(n, pyarrow.int64() 
+                                   if isinstance(c.type, Integer) else
+                                   pyarrow.bool_() 
+                                   if isinstance(c.type, Boolean) else
+                                   pyarrow.string()) for n, c in columns])
+    query   = select([c for n, c in columns], from_obj=[entry\
+                .outerjoin(dept, entry.c.department_id == dept.c.id)\
+                .outerjoin(proj, entry.c.project_id == proj.c.id)\
+                .outerjoin(task, entry.c.task_id == task.c.id)])\
+              .order_by(entry.c.date, entry.c.start_time, entry.c.id)
+    if start is not None:
+      query = query.where(entry.c.date >= start)
+    if end is not None:
+      query = query.where(entry.c.date <= end)
+    
+    def value(v):
+      if isinstance(v, datetime.time):
+        return v.strftime('%H:%M')
+      if isinstance(v, datetime.date):
+        return v.strftime('%Y-%m-%d')
+      return v
+    
+    if path in ('', '-'):
+      output = sys.stdout
     else:
-      print 'Not enough arguments.'
+      output = open(path, 'wb')
+    conn    = self.engine.connect()
+    result  = conn.execution_options(stream_results=True).execute(query)
+    count   = 0
+    writer  = None
+    try:
+      if fmt == 'csv':
+        import csv
+        writer = csv.writer(output)
+        writer.writerow(names)
+      if fmt == 'jsonl':
+        import json
+      if fmt == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(output, schema)
+      while True:
+        rows = result.fetchmany(block)
+        if len(rows) == 0:
+          break
+        count += len(rows)
+        rows  = [[value(v) for v in row] for row in rows]
+        if fmt == 'csv':
+          writer.writerows([[unicode(v).encode('utf-8') if v is not None 
+                             else '' for v in row] for row in rows])
+        if fmt == 'jsonl':
+          for row in rows:
+            output.write(json.dumps(dict(zip(names, row))) + '\n')
+        if fmt == 'parquet':
+          # Each block becomes a parquet row group, so only one block of
+          # columns is ever held in memory.
+          table = pyarrow.Table.from_arrays(
+                    [pyarrow.array([row[i] for row in rows], schema[i].type)
+                     for i in range(len(names))], schema=schema)
+          writer.write_table(table)
+    finally:
+      if fmt == 'parquet' and writer is not None:
+        writer.close()
+      result.close()
+      conn.close()
+      if output is not sys.stdout:
+        output.close()
+    if output is not sys.stdout:
+      print 'Exported %d entries to %s' % (count, path)
   
   def do_search(self, s):
     '''search [OPTIONS] [string]
-     -d (--dept)      Tells search to search departments instead.
-     -t (--template)  Tells search to search templates instead.
+    Searches the department, project, task, and template names (and the
+    template descriptions) and returns the best matches first.  Each word is
+    matched as a prefix, so "infra mon" will find "Infrastructure Monitoring".
+    
+     -p (--project)   Tells search to only search projects and tasks.
+     -d (--dept)      Tells search to only search departments.
+     -t (--template)  Tells search to only search templates.
+     -n (--limit) [NUM]  Sets the maximum number of results.  (Default: 50)
     '''
-    criteria = 'projects'
+    kinds = []
+    limit = 50
     # First thing we need to see if there are any optional arguments in the
     # line and parse those first.  If there are any we will override the
     # default settings that have already been specified.
-    opts, args  = getopt.getopt(s.split(), 'dt', ['template', 'dept'])
+    opts, args  = getopt.getopt(s.split(), 'pdtn:', 
+                                ['project', 'template', 'dept', 'limit='])
     for opt, val in opts:
+      if opt in ('-p', '--project'):
+        kinds += ['project', 'task']
       if opt in ('-d', '--dept'):
-        criteria = 'departments'
+        kinds.append('department')
       if opt in ('-t', '--template'):
-        criteria = 'templates'
-    if len(args) > 0:
-      search = ' '.join(args)
-    else:
+        kinds.append('template')
+      if opt in ('-n', '--limit'):
+        code, limit = self._int(val)
+        if not code: print limit; return
+    words = re.findall(r'\w+', ' '.join(args), re.U)
+    if len(words) == 0:
       print 'No Search Criteria Specified.'
       return
-    session  = self.smaker()
+    if not self.fts:
+      self._search_like(' '.join(args), kinds)
+      return
     
-    if criteria == 'projects':
+    # Every row in the search index uses a rowid of id * 4 + the kind's
+    # position in search_kinds, so one ranked query covers all of them.
+    query   = ' '.join(['"%s"*' % w for w in words])
+    where   = ''
+    if len(kinds) > 0:
+      where = ' AND rowid %% 4 IN (%s)' %\
+              ','.join([str(search_kinds.index(k)) for k in kinds])
+    conn    = self.engine.connect()
+    results = conn.execute('SELECT rowid, name, description, parent '
+                           'FROM search WHERE search MATCH ?%s '
+                           'ORDER BY bm25(search, 10.0, 1.0) LIMIT ?' % where,
+                           (query, limit)).fetchall()
+    conn.close()
+    for rowid, name, description, parent in results:
+      kind = search_kinds[rowid % 4]
+      rid  = rowid // 4
+      if kind == 'department':
+        print 'D: [%3d] %s' % (rid, name)
+      if kind == 'project':
+        print 'P: [%3d] %s' % (rid, name)
+      if kind == 'task':
+        print '\t[%3d %3d] %s' % (parent, rid, name)
+      if kind == 'template':
+        print 'T: [%3d] %s\n\t%s' % (rid, name, description)
+  
+  def _search_like(self, search, kinds):
+    '''
+    Private Function:  Searches the cached catalogue names and the templates
+    directly.  This is what search falls back to if sqlite wasn't built with
+    full text search.
+    '''
+    cat = self._catalogue()
+    
+    if len(kinds) == 0 or 'project' in kinds:
       # If we are doin a default search we will first search for any matches
       # in the projects table.  If we do, we will display the matching
       # projects and all of the tasks associated with that project.  IF there
       # are no project matches, then we will degrade to searching the tasks
       # themselves.
-      projects = session.query(Project).filter(Project.name.contains(search)).all()
-      for project in projects:
-        self._print_project(project)
+      projects = cat.find(cat.project_names, search)
+      for pid in projects:
+        self._print_project(pid)
       if len(projects) == 0:
-        tasks = session.query(Task).filter(Task.name.contains(search)).all()
-        for task in tasks:
-          self._print_task(task)
+        for tid in cat.find(cat.task_names, search):
+          self._print_task(tid)
     
-    if criteria == 'departments':
+    if len(kinds) == 0 or 'department' in kinds:
       # Here we will simply search through all the available departments and
       # return the matches.
-      departments = session.query(Department).filter(Department.name.contains(search)).all()
-      for department in departments:
-        self._print_department(department)
+      for did in cat.find(cat.department_names, search):
+        self._print_department(did)
     
-    if criteria == 'templates':
+    if len(kinds) == 0 or 'template' in kinds:
       # Same thing as departments, however we will also print out the actions
       # for each template.
-      temps = session.query(Template).filter(or_(\
-                      Template.name.contains(search),
-                      Template.description.contains(search))).all()
+      session = self.smaker()
+      temps = session.query(Template).options(subqueryload('actions'))\
+                     .filter(or_(Template.name.contains(search),
+                                 Template.description.contains(search))).all()
       for temp in temps:
         self._print_template(temp)
+      session.close()
   
   def do_list(self, s):
     '''list [OPTIONS]
@@ -527,62 +2453,137 @@ class TimeCardCLI(cmd.Cmd):
         criteria = 'templates'
     
     if criteria == 'projects':
-      # If we are doin a default search we will first search for any matches
-      # in the projects table.  If we do, we will display the matching
-      # projects and all of the tasks associated with that project.  IF there
-      # are no project matches, then we will degrade to searching the tasks
-      # themselves.
-      projects = session.query(Project).all()
-      for project in projects:
-        self._print_project(project)
-      if len(projects) == 0:
-        tasks = session.query(Task).filter_by(name=search).all()
-        for task in tasks:
-          self._print_task(task)
+      # The projects and their tasks come straight out of the catalogue
+      # cache.
+      for pid in sorted(self._catalogue().project_names):
+        self._print_project(pid)
 
     if criteria == 'departments':
-      # Here we will simply search through all the available departments and
-      # return the matches.
-      departments = session.query(Department).all()
-      for department in departments:
-        self._print_department(department)
+      # Here we will simply list all of the available departments.
+      for did in sorted(self._catalogue().department_names):
+        self._print_department(did)
 
     if criteria == 'templates':
       # Same thing as departments, however we will also print out the actions
       # for each template.
-      temps = session.query(Template).all()
+      temps = session.query(Template).options(subqueryload('actions')).all()
       for temp in temps:
         self._print_template(temp)
     
     session.close()
   
+  def do_check(self, s):
+    '''check [OPTIONS]
+    Checks the entries for a day or a range of days for entries that overlap
+    each other and for unlogged gaps between the entries.  Only the time
+    between a day's first and last entry is checked for gaps.
+    
+     -s (--start) [DATE]  The first day to check.  (Default: today)
+     -e (--end) [DATE]    The last day to check.  (Default: the start)
+     -w (--week) [DATE]   Checks the whole week (Sun-Sat) containing the date.
+     -g (--gap) [MINUTES] The shortest gap to report.  (Default: min_gap from
+                          the config file)
+     -E (--employee) [NAME]  Checks the entries of the roster employee.
+    '''
+    start   = datetime.date.today()
+    end     = None
+    minimum = self.config.getint('General', 'min_gap')
+    employee = None
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 's:e:w:g:E:', 
+                                ['start=', 'end=', 'week=', 'gap=', 
+                                 'employee='])
+    for opt, val in opts:
+      if opt in ('-E', '--employee'):
+        code, employee = self._employee(val)
+        if not code: print employee; return
+      if opt in ('-s', '--start'):
+        code, start = self._date(val)
+        if not code: print start; return
+      if opt in ('-e', '--end'):
+        code, end = self._date(val)
+        if not code: print end; return
+      if opt in ('-w', '--week'):
+        code, date = self._date(val)
+        if not code: print date; return
+        start = date - datetime.timedelta(int(date.strftime('%w')))
+        end   = start + datetime.timedelta(6)
+      if opt in ('-g', '--gap'):
+        code, minimum = self._int(val)
+        if not code: print minimum; return
+    if end is None:
+      end = start
+    count, problems = self._check(start, end, minimum, employee)
+    for date, problem in problems:
+      self._print_problem(date, problem)
+    overlaps = len([p for d, p in problems if p[0] == 'overlap'])
+    print 'Checked %d entries: %d overlaps, %d gaps.' %\
+          (count, overlaps, len(problems) - overlaps)
+  
   def do_push(self, s):
     '''push [OPTIONS]
-    Pushes the local entries up to the ATR timecard system.  Please note that
-    if you need to make changes after you have pushed the entries, you will
-    need to login to the web system to make the changes, or push the changes
-    and then delete the duplicates on the ATR system itself.
-    
-    Because of this, make sure that you really want to push your entries up
-    before you do so.
+    Pushes the local entries up to the ATR timecard system.  Entries that
+    have already been pushed are skipped, so it is safe to run push again
+    after a partial failure.  Please note that if you change an entry after it
+    has been pushed, the changed entry will be pushed again as a new entry and
+    you will need to delete the old one on the ATR system itself.
     
+     -f (--force)         Pushes the entries even if they have already been
+                          pushed.
      -d (--date)  [DATE]  Changes the date to the specified date.
      -e (--entry) [ID]    Sets the push type to a single entry and uses the
                           specified id.
      -w (--week) [DATE]   Sets the push type to a whole week and uses the date
                           specified to calculate a week range to pull (Sun-Sat)
+     -c (--concurrency) [NUM]  Overrides the number of entries that will be
+                          sent to ATRWeb at the same time.
+     -k (--check)         Checks the days being pushed first and refuses to
+                          push if any have overlapping entries or gaps.  This
+                          is always done if check_before_push is enabled.
+     -K (--no-check)      Skips the check, even if check_before_push is
+                          enabled.
+     -q (--queue)         Queues the entries in the outbox instead of sending
+                          them now.  See drain.
+     -E (--employee) [NAME]  Pushes the entries of the roster employee, as
+                          that employee, instead of your own.
+    
+    If ATRWeb can't be reached, or some of the entries fail, those entries are
+    queued in the outbox so that drain can retry them later.
     '''
     date    = datetime.date.today()
     entry   = None
     week    = None
     stype   = 'date'
+    force   = False
+    queue   = False
+    employee = None
+    check   = self.config.getboolean('General', 'check_before_push')
+    workers = self.config.getint('ATR', 'push_workers')
     session = self.smaker()
     # First thing we need to see if there are any optional arguments in the
     # line and parse those first.  If there are any we will override the
     # default settings that have already been specified.
-    opts, args  = getopt.getopt(s.split(), 'd:e:w:', 
-                                  ['date=', 'entry=', 'week='])
+    opts, args  = getopt.getopt(s.split(), 'd:e:w:c:fkKqE:', 
+                                  ['date=', 'entry=', 'week=', 'concurrency=',
+                                   'force', 'check', 'no-check', 'queue',
+                                   'employee='])
     for opt, val in opts:
+      if opt in ('-E', '--employee'):
+        code, employee = self._employee(val)
+        if not code: print employee; return
+      if opt in ('-f', '--force'):
+        force = True
+      if opt in ('-q', '--queue'):
+        queue = True
+      if opt in ('-k', '--check'):
+        check = True
+      if opt in ('-K', '--no-check'):
+        check = False
+      if opt in ('-c', '--concurrency'):
+        code, workers = self._int(val)
+        if not code: print workers; return
       if opt in ('-d', '--date'):
         code, date = self._date(val)
         if not code: print date; return
@@ -595,81 +2596,597 @@ class TimeCardCLI(cmd.Cmd):
         start = date - datetime.timedelta(int(date.strftime('%w')))
         end   = start + datetime.timedelta(6)
     
+    # Only the entries of the one employee are pushed, since they all go up
+    # under that employee's login.  A single entry is pushed as whoever it
+    # belongs to.
     time_entries = []
     if stype == 'date':
       time_entries = session.query(TimeEntry)\
-                        .filter(TimeEntry.date == date).all()
+                        .filter(TimeEntry.date == date)\
+                        .filter(TimeEntry.employee == employee).all()
     if stype == 'entry':
       time_entries = session.query(TimeEntry)\
                         .filter_by(id=entry).all()
+      if len(time_entries) > 0:
+        employee = time_entries[0].employee
     if stype == 'week':
       time_entries = session.query(TimeEntry)\
                         .filter(and_(TimeEntry.date >= start,
-                                     TimeEntry.date <= end))
+                                     TimeEntry.date <= end))\
+                        .filter(TimeEntry.employee == employee).all()
     
+    if check and len(time_entries) > 0:
+      dates     = set([item.date for item in time_entries])
+      count, problems = self._check(min(dates), max(dates),
+                                    self.config.getint('General', 'min_gap'),
+                                    employee)
+      problems  = [(d, p) for d, p in problems if d in dates]
+      if len(problems) > 0:
+        for day, problem in problems:
+          self._print_problem(day, problem)
+        print 'Not pushing.  Fix the entries above or push with --no-check.'
+        session.close()
+        return
+    
+    if queue:
+      count = self._enqueue(session.connection(), 
+                            [item.id for item in time_entries])
+      session.commit()
+      session.close()
+      print 'Queued %d entries in the outbox.' % count
+      return
+    
+    api = self._api_for(employee)
     try:
-      self.api.login()
+      api.connect()
     except:
       print 'ERROR: Could not talk to host.  check your configuration.'
+      if len(time_entries) > 0:
+        count = self._enqueue(session.connection(), 
+                              [item.id for item in time_entries])
+        session.commit()
+        print 'Queued %d entries in the outbox to be sent later.' % count
+      session.close()
       return
-    for item in time_entries:
-      self.api.add(item)
-      print 'Pushed Entry Number %s' % item.id
+    # The ledger check and the sends are done under the drain lock, so that
+    # the background drain can't send the same entries while we are.
+    with self.drain_lock:
+      # Now we check the push ledger so that only the entries that are new or
+      # have changed since they were last pushed get sent up.
+      digests = dict([(item.id, item.digest()) for item in time_entries])
+      if not force:
+        skipped       = len(time_entries)
+        time_entries  = self._unpushed(session, time_entries, digests)
+        skipped      -= len(time_entries)
+        if skipped > 0:
+          print 'Skipping %d entries that have already been pushed.' % skipped
+      
+      started = time.time()
+      failed  = self._record(session, api.add_many(time_entries, workers),
+                             digests, True)
+      session.commit()
+      print 'Pushed %d of %d entries (%d failed) in %.2f seconds.' %\
+            (len(time_entries) - len(failed), len(time_entries), len(failed),
+             time.time() - started)
+      if len(failed) > 0:
+        print 'Queued the %d failed entries in the outbox to be retried.' %\
+              len(failed)
     session.close()
   
-  def do_update(self, s):
-    '''update
-    Updates the Database to current.'''
+  def do_roster(self, s):
+    '''roster
+    Lists the employees in the roster along with how many entries each one
+    has and how many are waiting in the outbox.  Add an [Employee NAME]
+    section to the config file for each employee.
+    '''
+    entry   = TimeEntry.__table__
+    outbox  = Outbox.__table__
+    conn    = self.engine.connect()
+    counts  = dict([(r[0], r[1:]) for r in conn.execute(
+                select([entry.c.employee, func.count(entry.c.id),
+                        func.count(outbox.c.entry_id)],
+                       from_obj=[entry.outerjoin(outbox, 
+                                    outbox.c.entry_id == entry.c.id)])\
+                .group_by(entry.c.employee))])
+    conn.close()
+    print '%-16s %-16s %-8s %-24s %-8s %-8s' %\
+          ('EMPLOYEE', 'USERNAME', 'EMP ID', 'HOST', 'ENTRIES', 'QUEUED')
+    print '%-16s %-16s %-8s %-24s %-8s %-8s' %\
+          ('-' * 16, '-' * 16, '-' * 8, '-' * 24, '-' * 8, '-' * 8)
+    for name in self._roster():
+      section = 'Employee %s' % name
+      host    = self.config.get('ATR', 'host')
+      if self.config.has_option(section, 'host'):
+        host  = self.config.get(section, 'host')
+      entries, queued = counts.get(name, (0, 0))
+      print '%-16s %-16s %-8s %-24s %-8d %-8d' %\
+            (name, self.config.get(section, 'username'),
+             self.config.get(section, 'employee_id'), host, entries, queued)
+  
+  def do_roster_push(self, s):
+    '''roster_push [OPTIONS]
+    Pushes the entries of every employee in the roster at the same time, each
+    under their own login.  One employee failing (a bad password, say) doesn't
+    stop anyone else, and the results are listed per employee at the end.
+    Failed entries are queued in the outbox just like with push.
+    
+     -d (--date)  [DATE]  Changes the date to the specified date.
+     -w (--week) [DATE]   Pushes the whole week (Sun-Sat) containing the date.
+     -E (--employee) [NAME]  Only pushes for this employee.  This can be
+                          given more than once.
+     -p (--parallel) [NUM]  The number of employees pushed at the same time.
+                          (Default: 4)
+     -c (--concurrency) [NUM]  The number of entries sent at the same time for
+                          each employee.  (Default: push_workers)
+     -f (--force)         Pushes the entries even if they have already been
+                          pushed.
+     -k (--check)         Skips any employee whose entries have overlaps or
+                          gaps.  This is always done if check_before_push is
+                          enabled.
+     -K (--no-check)      Skips the check, even if check_before_push is
+                          enabled.
+    '''
+    start     = datetime.date.today()
+    end       = start
+    names     = []
+    parallel  = 4
+    workers   = self.config.getint('ATR', 'push_workers')
+    force     = False
+    check     = self.config.getboolean('General', 'check_before_push')
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 'd:w:E:p:c:fkK', 
+                                ['date=', 'week=', 'employee=', 'parallel=',
+                                 'concurrency=', 'force', 'check',
+                                 'no-check'])
+    for opt, val in opts:
+      if opt in ('-d', '--date'):
+        code, start = self._date(val)
+        if not code: print start; return
+        end = start
+      if opt in ('-w', '--week'):
+        code, date = self._date(val)
+        if not code: print date; return
+        start = date - datetime.timedelta(int(date.strftime('%w')))
+        end   = start + datetime.timedelta(6)
+      if opt in ('-E', '--employee'):
+        code, name = self._employee(val)
+        if not code: print name; return
+        names.append(name)
+      if opt in ('-p', '--parallel'):
+        code, parallel = self._int(val)
+        if not code: print parallel; return
+      if opt in ('-c', '--concurrency'):
+        code, workers = self._int(val)
+        if not code: print workers; return
+      if opt in ('-f', '--force'):
+        force = True
+      if opt in ('-k', '--check'):
+        check = True
+      if opt in ('-K', '--no-check'):
+        check = False
+    names   = names or self._roster()
+    if len(names) == 0:
+      print 'There is nobody in the roster.'
+      return
+    
+    # Everything that touches the database is done here up front and at the
+    # end, the threads in between only talk to ATRWeb.  The drain lock is held
+    # throughout so that the background drain can't send the same entries.
+    with self.drain_lock:
+      session = self.smaker()
+      jobs    = Queue.Queue()
+      results = {}
+      for name in names:
+        entries = session.query(TimeEntry)\
+                         .filter(and_(TimeEntry.date >= start, 
+                                      TimeEntry.date <= end,
+                                      TimeEntry.employee == name))\
+                         .order_by(TimeEntry.date, TimeEntry.start_time).all()
+        digests = dict([(item.id, item.digest()) for item in entries])
+        total   = len(entries)
+        if not force:
+          entries = self._unpushed(session, entries, digests)
+        result  = {'total': total, 'skipped': total - len(entries), 
+                   'entries': entries, 'digests': digests, 'results': [], 
+                   'error': None, 'seconds': 0.0}
+        results[name] = result
+        if check and len(entries) > 0:
+          count, problems = self._check(start, end, 
+                              self.config.getint('General', 'min_gap'), name)
+          if len(problems) > 0:
+            result['error']   = '%d overlaps or gaps, see check -E %s' %\
+                                (len(problems), name)
+            result['entries'] = []
+            continue
+        if len(entries) > 0:
+          jobs.put((name, self._api_for(name)))
+      
+      def worker():
+        while True:
+          try:
+            name, api = jobs.get_nowait()
+          except Queue.Empty:
+            return
+          result  = results[name]
+          started = time.time()
+          try:
+            api.connect()
+            result['results'] = api.add_many(result['entries'], workers)
+          except Exception, error:
+            result['error']   = str(error)
+          result['seconds'] = time.time() - started
+      
+      started = time.time()
+      threads = [threading.Thread(target=worker) 
+                 for i in range(min(max(parallel, 1), jobs.qsize()))]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      
+      print '%-16s %-8s %-8s %-8s %-8s %-8s %s' %\
+            ('EMPLOYEE', 'ENTRIES', 'SKIPPED', 'PUSHED', 'FAILED', 'SECONDS',
+             'ERROR')
+      print '%-16s %-8s %-8s %-8s %-8s %-8s %s' %\
+            ('-' * 16, '-' * 8, '-' * 8, '-' * 8, '-' * 8, '-' * 8, '-' * 20)
+      pushed  = 0
+      failed  = 0
+      for name in names:
+        result  = results[name]
+        entries = result['entries']
+        if result['error'] is not None and len(result['results']) == 0:
+          errors  = [item.id for item in entries]
+          if len(errors) > 0:
+            self._enqueue(session.connection(), errors)
+        else:
+          errors  = self._record(session, result['results'], 
+                                 result['digests'])
+          if len(errors) > 0:
+            result['error'] = [str(e) for i, r, e in result['results'] 
+                               if e is not None][0]
+        pushed += len(entries) - len(errors)
+        failed += len(errors)
+        print '%-16s %-8d %-8d %-8d %-8d %-8.2f %s' %\
+              (name, result['total'], result['skipped'], 
+               len(entries) - len(errors), len(errors), result['seconds'],
+               result['error'] or '')
+      session.commit()
+      session.close()
+    print 'Pushed %d entries for %d employees (%d failed) in %.2f seconds.' %\
+          (pushed, len(names), failed, time.time() - started)
+    if failed > 0:
+      print 'Queued the %d failed entries in the outbox to be retried.' % failed
+  
+  def do_reconcile(self, s):
+    '''reconcile [OPTIONS]
+    Compares the local entries against what ATRWeb actually has for a range
+    of days.  The day pages are fetched from ATRWeb several at a time, and
+    every entry is matched up by its date, start, and end time.  Reports the
+    local entries that are missing from ATRWeb, the entries on ATRWeb that
+    aren't here (extra), and the entries that match up but differ.
+    
+     -s (--start) [DATE]  The first day to reconcile.  (Default: today)
+     -e (--end) [DATE]    The last day to reconcile.  (Default: the start)
+     -w (--week) [DATE]   Reconciles the whole week (Sun-Sat) containing the
+                          date.
+     -E (--employee) [NAME]  Reconciles the entries of the roster employee.
+     -c (--concurrency) [NUM]  The number of day pages that are fetched at
+                          the same time.  (Default: push_workers)
+     -p (--push)          Pushes the missing entries to ATRWeb.  Entries that
+                          the push ledger says were already pushed are
+                          skipped.
+     -f (--force)         With -p, pushes the missing entries even if the
+                          push ledger says that they were already pushed.
+    
+    Days whose page can't be fetched or read are reported as errors and
+    nothing on them is pushed.
+    '''
+    start     = datetime.date.today()
+    end       = None
+    employee  = None
+    workers   = self.config.getint('ATR', 'push_workers')
+    push      = False
+    force     = False
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 's:e:w:E:c:pf', 
+                                ['start=', 'end=', 'week=', 'employee=',
+                                 'concurrency=', 'push', 'force'])
+    for opt, val in opts:
+      if opt in ('-s', '--start'):
+        code, start = self._date(val)
+        if not code: print start; return
+      if opt in ('-e', '--end'):
+        code, end = self._date(val)
+        if not code: print end; return
+      if opt in ('-w', '--week'):
+        code, date = self._date(val)
+        if not code: print date; return
+        start = date - datetime.timedelta(int(date.strftime('%w')))
+        end   = start + datetime.timedelta(6)
+      if opt in ('-E', '--employee'):
+        code, employee = self._employee(val)
+        if not code: print employee; return
+      if opt in ('-c', '--concurrency'):
+        code, workers = self._int(val)
+        if not code: print workers; return
+      if opt in ('-p', '--push'):
+        push = True
+      if opt in ('-f', '--force'):
+        force = True
+    if end is None:
+      end = start
+    if end < start:
+      print 'The end date is before the start date.'
+      return
+    
+    dates   = [start + datetime.timedelta(days=i) 
+               for i in range((end - start).days + 1)]
+    api     = self._api_for(employee)
+    try:
+      api.connect()
+    except:
+      print 'ERROR: Could not talk to host.  check your configuration.'
+      return
+    started = time.time()
+    pages   = api.day_entries_many(dates, workers)
+    fetched = time.time() - started
+    
     session = self.smaker()
+    local   = {}
+    for entry in session.query(TimeEntry)\
+                        .filter(and_(TimeEntry.date >= start,
+                                     TimeEntry.date <= end,
+                                     TimeEntry.employee == employee))\
+                        .order_by(TimeEntry.date, TimeEntry.start_time,
+                                  TimeEntry.id):
+      local.setdefault(entry.date, []).append(entry)
     
-    self.api.login()
-    db = self.api.pull_database()
-    for item in db['departments']:
-      try:
-        dept      = session.query(Department).filter_by(id=item).one()
-        dept.name = db['departments'][item]
-        session.merge(dept)
-        print 'Updating Department: %s' % dept.name
-      except:
-        dept      = Department()
-        dept.id   = item
-        dept.name = db['departments'][item]
-        session.add(dept)
-        print 'Adding Department: %s' % dept.name
-    session.commit()
+    # Entries are paired up by their date and times.  If there is more than
+    # one entry with the same times, they are paired in order.
+    fields  = ['department_id', 'project_id', 'task_id', 'billable',
+               'description', 'notes']
+    missing = []
+    counts  = {'local': 0, 'remote': 0, 'extra': 0, 'mismatched': 0}
+    def span(item):
+      return '%s-%s' % (item.start_time.strftime('%H:%M'), 
+                        item.end_time.strftime('%H:%M'))
+    for date, remote, error in pages:
+      day = date.strftime('%Y-%m-%d')
+      if remote is None:
+        print '%s ERROR    could not fetch the day: %s' % (day, error)
+        continue
+      entries = local.get(date, [])
+      counts['local']   += len(entries)
+      counts['remote']  += len(remote)
+      timings = {}
+      for timing in remote:
+        timings.setdefault((timing['start_time'], timing['end_time']), 
+                           []).append(timing)
+      for entry in entries:
+        matches = timings.get((entry.start_time, entry.end_time))
+        if not matches:
+          missing.append(entry)
+          print '%s MISSING  %s entry %s: %s' %\
+                (day, span(entry), entry.id, entry.description)
+          continue
+        timing  = matches.pop(0)
+        differs = [name for name in fields 
+                   if (getattr(entry, name) or None) != (timing[name] or None)]
+        if len(differs) > 0:
+          counts['mismatched'] += 1
+          print '%s MISMATCH %s entry %s, timing %s: %s' %\
+                (day, span(entry), entry.id, timing['id'], ', '.join(differs))
+      for matches in timings.values():
+        for timing in matches:
+          counts['extra'] += 1
+          print '%s EXTRA    %s-%s timing %s: %s' %\
+                (day, timing['start_time'].strftime('%H:%M'), 
+                 timing['end_time'].strftime('%H:%M'), timing['id'], 
+                 timing['description'])
+    print 'Reconciled %d days in %.2f seconds: %d local, %d on ATRWeb, '\
+          '%d missing, %d extra, %d mismatched.' %\
+          (len(dates), fetched, counts['local'], counts['remote'], 
+           len(missing), counts['extra'], counts['mismatched'])
     
-    for item in db['projects']:
-      try:
-        proj      = session.query(Project).filter_by(id=item).one()
-        proj.name = db['projects'][item]['value']
-        session.merge(proj)
-        session.commit()
-        print 'Updating Project: %s' % proj.name
-      except:
-        proj      = Project()
-        proj.id   = item
-        proj.name = db['projects'][item]['value']
-        session.add(proj)
+    if push and len(missing) > 0:
+      # Sent under the drain lock, just like push.
+      with self.drain_lock:
+        digests = dict([(item.id, item.digest()) for item in missing])
+        if not force:
+          skipped  = len(missing)
+          missing  = self._unpushed(session, missing, digests)
+          skipped -= len(missing)
+          if skipped > 0:
+            print 'Skipping %d missing entries that the push ledger says '\
+                  'were already pushed (use -f to push them anyway).' %\
+                  skipped
+        failed  = self._record(session, api.add_many(missing, workers), 
+                               digests, True)
         session.commit()
-        print 'Adding Project: %s' % proj.name
-      for tid in db['projects'][item]['tasks']:
-        try:
-          task      = session.query(Task).filter_by(id=tid).one()
-          task.project_id = item
-          task.name = db['projects'][item]['tasks'][tid]
-          session.merge(task)
-          session.commit()
-          print 'Updating Task: %s' % task.name
-        except:
-          task      = Task()
-          task.id   = tid
-          task.project_id = item
-          task.name = db['projects'][item]['tasks'][tid]
-          session.add(task)
-          session.commit()
-          print 'Adding Task: %s' % task.name
+      print 'Pushed %d of %d missing entries (%d failed).' %\
+            (len(missing) - len(failed), len(missing), len(failed))
+      if len(failed) > 0:
+        print 'Queued the %d failed entries in the outbox to be retried.' %\
+              len(failed)
     session.close()
   
+  def do_drain(self, s):
+    '''drain [OPTIONS]
+    Sends the entries waiting in the outbox to ATRWeb.  Entries that fail are
+    kept in the outbox and retried later, waiting longer after each failure
+    (see retry_base and retry_max in the config file).  While the interactive
+    prompt is open this also happens in the background.
+    
+     -a (--all)           Sends everything in the outbox now, even entries
+                          that are still waiting to be retried.
+     -c (--concurrency) [NUM]  Overrides the number of entries that will be
+                          sent to ATRWeb at the same time.
+    '''
+    due     = True
+    workers = self.config.getint('ATR', 'push_workers')
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 'ac:', ['all', 'concurrency='])
+    for opt, val in opts:
+      if opt in ('-a', '--all'):
+        due = False
+      if opt in ('-c', '--concurrency'):
+        code, workers = self._int(val)
+        if not code: print workers; return
+    started = time.time()
+    sent, failed, skipped = self._drain(due, workers)
+    print 'Sent %d entries (%d failed, %d already pushed) in %.2f seconds.' %\
+          (sent, failed, skipped, time.time() - started)
+  
+  def do_outbox(self, s):
+    '''outbox
+    Lists the entries waiting in the outbox to be sent to ATRWeb.
+    '''
+    session = self.smaker()
+    print '%-6s %-10s %-5s %-8s %-19s %s' %\
+          ('ENTRY', 'DATE', 'START', 'ATTEMPTS', 'NEXT TRY', 'LAST ERROR')
+    print '%-6s %-10s %-5s %-8s %-19s %s' %\
+          ('-' * 6, '-' * 10, '-' * 5, '-' * 8, '-' * 19, '-' * 20)
+    for entry, item in session.query(TimeEntry, Outbox)\
+                  .join(Outbox, Outbox.entry_id == TimeEntry.id)\
+                  .order_by(Outbox.next_try, TimeEntry.id):
+      print '%-6d %-10s %-5s %-8d %-19s %s' %\
+            (entry.id, entry.date.strftime('%Y-%m-%d'), 
+             entry.start_time.strftime('%H:%M'), item.attempts or 0,
+             item.next_try.strftime('%Y-%m-%d %H:%M:%S'), 
+             item.last_error or '')
+    session.close()
+  
+  def do_update(self, s):
+    '''update [OPTIONS]
+    Updates the Database to current.  Departments, projects, and tasks that
+    are no longer in ATRWeb are removed, unless there are local entries or
+    template actions that still use them.  A fingerprint of the catalogue is
+    kept between runs, so if nothing has changed in ATRWeb the database isn't
+    touched at all, and otherwise only the projects that differ are synced.
+    
+     -f (--full)          Ignores the saved fingerprints and compares the
+                          whole catalogue.
+     -v (--verbose)       Prints every department, project, and task that was
+                          added, renamed, moved, or removed.
+    '''
+    full    = False
+    verbose = False
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 'fv', ['full', 'verbose'])
+    for opt, val in opts:
+      if opt in ('-f', '--full'):
+        full = True
+      if opt in ('-v', '--verbose'):
+        verbose = True
+    
+    db      = self.api.pull_database()
+    depts   = dict([(did, {'name': name}) 
+                    for did, name in db['departments'].items()])
+    projs   = {}
+    tasks   = {}
+    for pid, proj in db['projects'].items():
+      projs[pid] = {'name': proj['value']}
+      for tid, name in proj['tasks'].items():
+        tasks[tid] = {'project_id': pid, 'name': name}
+    
+    # Now we fingerprint what we pulled.  Each project gets a hash of its name
+    # and task list, and the catalogue as a whole gets a hash of all of those
+    # along with the departments.
+    prints  = {'departments': self._digest(sorted(db['departments'].items()))}
+    for pid, proj in db['projects'].items():
+      prints['project:%d' % pid] = self._digest([proj['value']] +
+                                                sorted(proj['tasks'].items()))
+    prints['catalogue'] = self._digest(sorted(prints.items()))
+    
+    with self.engine.begin() as conn:
+      table   = Fingerprint.__table__
+      stored  = {}
+      if not full:
+        stored = dict([(r['name'], r['digest']) 
+                       for r in conn.execute(select([table]))])
+      if stored.get('catalogue') == prints['catalogue']:
+        print 'The catalogue has not changed.'
+        return
+      
+      # Only the projects whose fingerprint differs (or that have disappeared
+      # from ATRWeb) need to be looked at.  If we do not have any fingerprints
+      # yet every project counts as changed and we simply compare everything.
+      # Otherwise the existing rows are looked up by id, in chunks that stay
+      # under SQLite's limit on bound parameters.
+      changed = [pid for pid in projs if stored.get('project:%d' % pid) 
+                                          != prints['project:%d' % pid]]
+      gone    = [int(n.split(':')[1]) for n in stored 
+                 if n.startswith('project:') and n not in prints]
+      cset    = set(changed)
+      tids    = [tid for tid in tasks if tasks[tid]['project_id'] in cset]
+      pscopes = None
+      tscopes = None
+      if len(stored) > 0:
+        pids    = changed + gone
+        pscopes = [Project.__table__.c.id.in_(pids[i:i + 500])
+                   for i in range(0, len(pids), 500)]
+        tscopes = [Task.__table__.c.project_id.in_(pids[i:i + 500])
+                   for i in range(0, len(pids), 500)] +\
+                  [Task.__table__.c.id.in_(tids[i:i + 500])
+                   for i in range(0, len(tids), 500)]
+      
+      # The tasks are synced before the projects so that we know which of the
+      # retired projects still have tasks hanging off of them.
+      results = [('Department', ([], [], [])), 
+                 ('Task', self._sync(conn, Task.__table__,
+                                     dict([(t, tasks[t]) for t in tids]),
+                                     self._in_use(conn, 'task_id'), tscopes))]
+      if stored.get('departments') != prints['departments']:
+        results[0] = ('Department', self._sync(conn, Department.__table__, 
+                          depts, self._in_use(conn, 'department_id')))
+      keep = self._in_use(conn, 'project_id')
+      keep.update([r[0] for r in conn.execute(
+                    select([Task.__table__.c.project_id]).distinct())])
+      results.insert(1, ('Project', self._sync(conn, Project.__table__, 
+                          dict([(p, projs[p]) for p in changed]), keep,
+                          pscopes)))
+      
+      for name, changes in results:
+        self._reindex(conn, name.lower(), *changes)
+      
+      # Lastly we save the new fingerprints for the next run.
+      if len(stored) == 0:
+        conn.execute(table.delete())
+        conn.execute(table.insert(), [{'name': n, 'digest': d} 
+                                      for n, d in prints.items()])
+      else:
+        names = ['catalogue', 'departments'] +\
+                ['project:%d' % p for p in changed + gone]
+        conn.execute(table.delete().where(table.c.name == bindparam('_name')),
+                     [{'_name': n} for n in names])
+        conn.execute(table.insert(), [{'name': n, 'digest': prints[n]} 
+                                      for n in names if n in prints])
+    
+    for name, (added, updated, removed) in results:
+      if verbose:
+        for rid, row in added:
+          print 'Added %s: [%d] %s' % (name, rid, row['name'])
+        for rid, old, row in updated:
+          if old['name'] != row['name']:
+            print 'Renamed %s: [%d] %s -> %s' % (name, rid, old['name'], 
+                                                 row['name'])
+          else:
+            print 'Moved %s: [%d] %s [%d] -> [%d]' % (name, rid, row['name'],
+                                   old['project_id'], row['project_id'])
+        for rid, old in removed:
+          print 'Removed %s: [%d] %s' % (name, rid, old['name'])
+      print '%-12s %6d added, %6d changed, %6d removed' %\
+            (name + 's:', len(added), len(updated), len(removed))
+    self.catalogue = None
+  
   def do_del(self, s):
     '''del [OPTIONS]
      -e (--entry) [ID]    Deletes the specified entry from the local db.
@@ -692,10 +3209,20 @@ class TimeCardCLI(cmd.Cmd):
         code, eid = self._int(val)
         if not code: print eid; return
     
+    # The push ledger and outbox entries go along with the entries themselves,
+    # otherwise a new entry that reuses the id would look like it was already
+    # pushed (or would be sent in place of the deleted one).
     if delete == 'date':
+      eids = session.query(TimeEntry.id).filter(TimeEntry.date == date)
+      session.query(PushRecord).filter(PushRecord.entry_id.in_(\
+                  eids.subquery())).delete(synchronize_session=False)
+      session.query(Outbox).filter(Outbox.entry_id.in_(\
+                  eids.subquery())).delete(synchronize_session=False)
       session.query(TimeEntry).filter(TimeEntry.date == date).delete()
       print 'Deleted all entries from %s' % date.strftime('%Y-%m-%d')
     if delete == 'entry':
+      session.query(PushRecord).filter(PushRecord.entry_id == eid).delete()
+      session.query(Outbox).filter(Outbox.entry_id == eid).delete()
       session.query(TimeEntry).filter(TimeEntry.id == eid).delete()
       print 'Deleted entry %s' % eid
     session.commit()
@@ -706,17 +3233,32 @@ class TimeCardCLI(cmd.Cmd):
     The run function wil run a template with the options that were specified.
     
      -d (--date) [DATE]         Overrides the current date with the provided one.
+     -e (--end) [DATE]          Runs the template on every day from the date
+                                up to and including this one.
+     -w (--weekdays)            Skips Saturdays and Sundays when running over
+                                a range of dates.
      -f (--field) [NAME:VALUE]  Will add the name/value pair to the fields to
                                 be replace dictionary.
+     -q (--queue)               Queues the new entries in the outbox to be
+                                sent to ATRWeb.
+     -E (--employee) [NAME]     Adds the entries for the roster employee.
     '''
-    session = self.smaker()
-    date    = datetime.date.today()
-    fields  = {}
+    date      = datetime.date.today()
+    end       = None
+    weekdays  = False
+    queue     = False
+    employee  = None
+    fields    = {}
     # First thing we need to see if there are any optional arguments in the
     # line and parse those first.  If there are any we will override the
     # default settings that have already been specified.
-    opts, args  = getopt.getopt(s.split(), 'd:f:', ['date=','field='])
+    opts, args  = getopt.getopt(s.split(), 'd:e:wf:qE:', 
+                                ['date=', 'end=', 'weekdays', 'field=', 
+                                 'queue', 'employee='])
     for opt, val in opts:
+      if opt in ('-E', '--employee'):
+        code, employee = self._employee(val)
+        if not code: print employee; return
       if opt in ('-d', '--date'):
         try:
           year, month, day = val.split('-')
@@ -724,33 +3266,68 @@ class TimeCardCLI(cmd.Cmd):
         except:
           print 'Invalid Year Argument.  Must be YYYY-MM-DD'
           return
+      if opt in ('-e', '--end'):
+        code, end = self._date(val)
+        if not code: print end; return
+      if opt in ('-w', '--weekdays'):
+        weekdays = True
+      if opt in ('-q', '--queue'):
+        queue = True
       if opt in ('-f', '--field'):
         try:
-          dset = val.split(':')
+          dset = val.split(':', 1)
           fields[dset[0].upper()] = dset[1]
         except:
           print 'Invalid Field Parameter.  Must be name:value'
-    if args < 2:
+    if len(args) < 2:
       print 'Not enough Arguments.'
       return
     try:
       hour, minute  = args[1].split(':')
-      start_time    = datetime.datetime(date.year, date.month, date.day, 
-                                        int(hour), int(minute))
+      start_time    = datetime.time(int(hour), int(minute))
     except:
       print 'Invalid Parameters, cannot run template.'
       return
-    try:
-      template  = session.query(Template).filter_by(name=args[0]).one()
-    except:
+    ranged    = end is not None
+    if not ranged:
+      end = date
+    if end < date:
+      print 'The end date is before the start date.'
+      return
+    session   = self.smaker()
+    template  = self._template(session, args[0])
+    session.close()
+    if template is None:
       print 'Not a valid Template ID.'
       return
-    tracker = start_time
-    for action in template.actions:
-      entry   = action.gen_entry(tracker, fields)
-      tracker = tracker + datetime.timedelta(minutes=action.duration)
-      session.add(entry)
-    session.commit()
+    missing   = template.missing(fields)
+    if len(missing) > 0:
+      print 'Missing Fields: %s' % ', '.join(missing)
+      return
+    
+    # Every day in the range gets expanded up front and then all of the
+    # entries go into the database as one insert in one transaction.
+    rows      = []
+    while date <= end:
+      if not weekdays or date.weekday() < 5:
+        rows.extend(template.expand(datetime.datetime.combine(date, 
+                                                    start_time), fields))
+      date += datetime.timedelta(days=1)
+    for row in rows:
+      row['employee'] = employee
+    if len(rows) > 0:
+      entry = TimeEntry.__table__
+      conn  = self.engine.connect()
+      trans = conn.begin()
+      last  = conn.execute(select([func.max(entry.c.id)])).scalar() or 0
+      conn.execute(entry.insert(), rows)
+      if queue:
+        self._enqueue(conn, select([entry.c.id]).where(entry.c.id > last))
+      trans.commit()
+      conn.close()
+      self._warn_overlaps(rows[0]['date'], rows[-1]['date'], employee)
+    if ranged:
+      print 'Added %d entries.' % len(rows)
     
   def do_tmpl_new(self, s):
     '''tmpl_new
@@ -763,8 +3340,13 @@ class TimeCardCLI(cmd.Cmd):
     tmpl.description  = raw_input('Enter Description : ')
     session = self.smaker()
     session.add(tmpl)
+    session.flush()
+    self._reindex(session.connection(), 'template', [(tmpl.id, {
+                    'name': tmpl.name, 'description': tmpl.description})])
+    self.compiled.pop(tmpl.name, None)
     session.commit()
     session.close() 
+    self.catalogue = None
   
   def do_tmpl_add(self, s):
     '''tmpl_add [OPTIONS] [template_name] [stack_id] [duration] 
@@ -820,6 +3402,7 @@ class TimeCardCLI(cmd.Cmd):
     else:
       print 'Action added to Database.'
       session.close()
+      self.compiled.pop(args[0], None)
     
   
   def do_tmpl_show(self, s):
@@ -828,25 +3411,212 @@ class TimeCardCLI(cmd.Cmd):
     '''
     session = self.smaker()
     try:
-      tmpl  = session.query(Template).filter_by(name=s).one()
+      tmpl  = session.query(Template).options(subqueryload('actions'))\
+                     .filter_by(name=s).one()
       self._print_template(tmpl)
     except:
       print 'Could not find any templates by that name.'
   
+  def do_sched_new(self, s):
+    '''sched_new [OPTIONS] [template_name] [time] [RULE]
+    Schedules the template to run at the time on every day that matches the
+    rule.  Nothing is added until materialize is run.  The rules are:
+    
+      daily
+      weekdays
+      weekly DAYS                       e.g. weekly mon,wed,fri
+      every [other|N weeks] [on] DAYS   e.g. every other friday
+    
+     -s (--start) [DATE]        The first day of the schedule.  The weeks for
+                                "every other" are counted from this date.
+                                Defaults to today.
+     -f (--field) [NAME:VALUE]  Will add the name/value pair to the fields to
+                                be replace dictionary.
+    '''
+    import json
+    first   = datetime.date.today()
+    fields  = {}
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 's:f:', ['start=', 'field='])
+    for opt, val in opts:
+      if opt in ('-s', '--start'):
+        code, first = self._date(val)
+        if not code: print first; return
+      if opt in ('-f', '--field'):
+        try:
+          dset = val.split(':', 1)
+          fields[dset[0].upper()] = dset[1]
+        except:
+          print 'Invalid Field Parameter.  Must be name:value'
+          return
+    if len(args) < 3:
+      print 'Not enough Arguments.'
+      return
+    code, start_time = self._time(args[1])
+    if not code: print start_time; return
+    try:
+      days, interval = Schedule.parse_rule(args[2:])
+    except ValueError:
+      print 'Invalid Rule.  See help sched_new.'
+      return
+    session   = self.smaker()
+    template  = self._template(session, args[0])
+    if template is None:
+      print 'Not a valid Template ID.'
+      session.close()
+      return
+    missing   = template.missing(fields)
+    if len(missing) > 0:
+      print 'Missing Fields: %s' % ', '.join(missing)
+      session.close()
+      return
+    sched             = Schedule()
+    sched.template_id = template.id
+    sched.start_time  = start_time
+    sched.days        = days
+    sched.interval    = interval
+    sched.first       = first
+    sched.through     = first - datetime.timedelta(days=1)
+    sched.fields      = json.dumps(fields)
+    session.add(sched)
+    session.commit()
+    print 'Added schedule %d: %s at %s %s' % (sched.id, args[0], 
+            start_time.strftime('%H:%M'), sched.describe())
+    session.close()
+  
+  def do_sched_list(self, s):
+    '''sched_list
+    Lists all of the schedules and how far each one has been materialized.
+    '''
+    session = self.smaker()
+    print '%-4s %-16s %-5s %-10s %-10s %s' %\
+          ('ID', 'TEMPLATE', 'TIME', 'FIRST', 'THROUGH', 'RULE')
+    print '%-4s %-16s %-5s %-10s %-10s %s' %\
+          ('-' * 4, '-' * 16, '-' * 5, '-' * 10, '-' * 10, '-' * 20)
+    for sched in session.query(Schedule).options(joinedload('template'))\
+                        .order_by(Schedule.id):
+      print '%-4d %-16s %-5s %-10s %-10s %s' %\
+            (sched.id, sched.template.name if sched.template else '?',
+             sched.start_time.strftime('%H:%M'),
+             sched.first.strftime('%Y-%m-%d'),
+             sched.through.strftime('%Y-%m-%d'), sched.describe())
+    session.close()
+  
+  def do_sched_del(self, s):
+    '''sched_del [ID]
+    Deletes the schedule.  Any entries that it has already added are kept.
+    '''
+    code, sid = self._int(s)
+    if not code: print sid; return
+    session = self.smaker()
+    if session.query(Schedule).filter(Schedule.id == sid).delete() == 0:
+      print 'Not a valid Schedule ID.'
+    else:
+      print 'Deleted schedule %d' % sid
+    session.commit()
+    session.close()
+  
+  def do_materialize(self, s):
+    '''materialize [OPTIONS]
+    Adds the entries for every scheduled occurrence up to and including the
+    date.  Each schedule remembers the last day it was materialized through,
+    so running this again only adds the occurrences since then, and past
+    occurrences are never added twice (even if those entries are deleted).
+    
+     -u (--until) [DATE]  Materializes up to this date.  Defaults to today.
+     -n (--dry-run)       Prints what would be added without adding anything.
+    '''
+    import json
+    until   = datetime.date.today()
+    dry_run = False
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 'u:n', ['until=', 'dry-run'])
+    for opt, val in opts:
+      if opt in ('-u', '--until'):
+        code, until = self._date(val)
+        if not code: print until; return
+      if opt in ('-n', '--dry-run'):
+        dry_run = True
+    
+    # All of the schedules are expanded in memory with the compiled templates
+    # and then everything goes in as one insert, along with the new high-water
+    # marks, in a single transaction.  If anything fails nothing moves.
+    session = self.smaker()
+    marks   = []
+    for sched in session.query(Schedule).options(joinedload('template'))\
+                        .filter(Schedule.through < until)\
+                        .order_by(Schedule.id):
+      if sched.template is None:
+        print 'Schedule %d: the template no longer exists.' % sched.id
+        continue
+      template  = self._template(session, sched.template.name)
+      fields    = json.loads(sched.fields or '{}')
+      missing   = template.missing(fields)
+      if len(missing) > 0:
+        print 'Schedule %d: Missing Fields: %s' % (sched.id, 
+                                                   ', '.join(missing))
+        continue
+      date      = sched.through + datetime.timedelta(days=1)
+      expanded  = []
+      while date <= until:
+        if sched.due(date):
+          expanded.extend(template.expand(datetime.datetime.combine(date, 
+                                            sched.start_time), fields))
+        date += datetime.timedelta(days=1)
+      marks.append((sched.id, sched.through, expanded))
+      print 'Schedule %d: %d entries through %s' %\
+            (sched.id, len(expanded), until.strftime('%Y-%m-%d'))
+    session.close()
+    if dry_run or len(marks) == 0:
+      return
+    
+    # Each high-water mark is only moved if it is still where we read it.  If
+    # another run (cron and the daemon, say) got there first, it has already
+    # added those occurrences, so that schedule's entries are dropped.
+    schedule = Schedule.__table__
+    update   = schedule.update().where(and_(schedule.c.id == bindparam('sid'),
+                                            schedule.c.through == 
+                                              bindparam('old')))\
+                                .values(through=bindparam('mark'))
+    rows  = []
+    conn  = self.engine.connect()
+    trans = conn.begin()
+    for sid, old, expanded in marks:
+      if conn.execute(update, sid=sid, old=old, mark=until).rowcount == 0:
+        print 'Schedule %d: already materialized by another run.' % sid
+        continue
+      rows.extend(expanded)
+    if len(rows) > 0:
+      conn.execute(TimeEntry.__table__.insert(), rows)
+    trans.commit()
+    conn.close()
+    print 'Added %d entries.' % len(rows)
+  
   def do_show(self, s):
     '''show [OPTIONS]
     Shows the entries associated with a given date.  If no date is given the
     current date will be used.
+    
+     -E (--employee) [NAME]   Shows the entries of the roster employee.
     '''
     date  = datetime.date.today()
     lform = False
     bill  = {True: 'X', False: ' '}
+    employee = None
     
     # First thing we need to see if there are any optional arguments in the
     # line and parse those first.  If there are any we will override the
     # default settings that have already been specified.
-    opts, args  = getopt.getopt(s.split(), 'd:l', ['date=','long'])
+    opts, args  = getopt.getopt(s.split(), 'd:lE:', 
+                                ['date=', 'long', 'employee='])
     for opt, val in opts:
+      if opt in ('-E', '--employee'):
+        code, employee = self._employee(val)
+        if not code: print employee; return
       if opt in ('-d', '--date'):
         try:
           year, month, day = val.split('-')
@@ -857,8 +3627,13 @@ class TimeCardCLI(cmd.Cmd):
       if opt in ('-l', '--long'):
         lform = True
     
+    # The names come from the catalogue cache, so only the entries
+    # themselves are queried.
+    cat     = self._catalogue()
     session = self.smaker()
-    entries = session.query(TimeEntry).filter_by(date=date).order_by(TimeEntry.start_time).all()
+    entries = session.query(TimeEntry)\
+                     .filter_by(date=date, employee=employee)\
+                     .order_by(TimeEntry.start_time).all()
     
     if lform:
       print '%-4s %1s %-10s %-5s %-5s %-30s %-30s %-40s %-30s\n' %\
@@ -871,35 +3646,245 @@ class TimeCardCLI(cmd.Cmd):
             '%-4s %s %-10s %-5s %-5s %-5s %-5s %-5s %-30s'    %\
             ('-'*4, '-', '-'*10, '-'*5, '-'*5, '-'*5, '-'*5, '-'*5, '-'*30)
     for entry in entries:
-      if entry.task is None:
-        tname = ''
-        tid   = 0
-      else:
-        tname = entry.task.name
-        tid = entry.task.id
+      tid   = entry.task_id or 0
+      tname = cat.task_names.get(entry.task_id) or ''
+      dname = cat.department_names.get(entry.department_id) or ''
+      pname = cat.project_names.get(entry.project_id) or ''
       if lform:
         print '%-4d %s %-10s %-5s %-5s %-30s %-30s %-40s %-30s' %\
               (entry.id, bill[entry.billable], entry.date.strftime('%Y-%m-%d'),
                entry.start_time.strftime('%H:%M'), entry.end_time.strftime('%H:%M'),
-               '%-25s[%3d]' % (entry.department.name[:25], entry.department.id), 
-               '%-25s[%3d]' % (entry.project.name[:25], entry.project.id),
+               '%-25s[%3d]' % (dname[:25], entry.department_id), 
+               '%-25s[%3d]' % (pname[:25], entry.project_id),
                '%-35s[%3d]' % (tname[:35], tid),
                entry.description)
       else:
         print '%-4s %s %-10s %-5s %-5s %-5s %-5s %-5s %-30s' %\
               (entry.id, bill[entry.billable], entry.date.strftime('%Y-%m-%d'),
                entry.start_time.strftime('%H:%M'), entry.end_time.strftime('%H:%M'),
-               '[%3d]' % entry.department.id, '[%3d]' % entry.project.id,
+               '[%3d]' % entry.department_id, '[%3d]' % entry.project_id,
                '[%3d]' % tid, entry.description)
     
   
+  def _minutes(self, column):
+    '''
+    Private Function:  Returns an SQL expression for the number of minutes
+    past midnight of a time column.
+    '''
+    return cast(func.substr(column, 1, 2), Integer) * 60 +\
+           cast(func.substr(column, 4, 2), Integer)
+  
+  def do_report(self, s):
+    '''report [OPTIONS]
+    Reports the hours that were logged over a range of dates, grouped however
+    you would like.  All of the adding up is done by sqlite, so this stays
+    quick even over years of entries.
+    
+     -s (--start) [DATE]  The first day of the report.  (Default: today)
+     -e (--end) [DATE]    The last day of the report.  (Default: the start)
+     -g (--group) [KEYS]  A comma separated list of what to group the hours
+                          by.  Any of day, week, month, department, project,
+                          task, and billable.  (Default: project)
+     -c (--csv)           Outputs CSV instead of a table.
+    '''
+    start   = datetime.date.today()
+    end     = None
+    groups  = ['project']
+    csvout  = False
+    # First thing we need to see if there are any optional arguments in the
+    # line and parse those first.  If there are any we will override the
+    # default settings that have already been specified.
+    opts, args  = getopt.getopt(s.split(), 's:e:g:c', 
+                                ['start=', 'end=', 'group=', 'csv'])
+    for opt, val in opts:
+      if opt in ('-s', '--start'):
+        code, start = self._date(val)
+        if not code: print start; return
+      if opt in ('-e', '--end'):
+        code, end = self._date(val)
+        if not code: print end; return
+      if opt in ('-g', '--group'):
+        groups = [g.strip().lower() for g in val.split(',') if g.strip()]
+      if opt in ('-c', '--csv'):
+        csvout = True
+    if end is None:
+      end = start
+    
+    entry   = TimeEntry.__table__
+    dept    = Department.__table__
+    proj    = Project.__table__
+    task    = Task.__table__
+    keys    = {
+             'day': [('DAY', entry.c.date)],
+            'week': [('WEEK', func.date(entry.c.date, '-' + 
+                        func.strftime('%w', entry.c.date) + ' days'))],
+           'month': [('MONTH', func.strftime('%Y-%m', entry.c.date))],
+      'department': [('DEPT', entry.c.department_id), 
+                     ('DEPARTMENT', dept.c.name)],
+         'project': [('PROJ', entry.c.project_id), ('PROJECT', proj.c.name)],
+            'task': [('TASK', entry.c.task_id), ('TASK NAME', task.c.name)],
+        'billable': [('BILLABLE', entry.c.billable)],
+    }
+    for group in groups:
+      if group not in keys:
+        print 'Invalid Group %s.  Must be one of %s' %\
+              (group, ', '.join(sorted(keys.keys())))
+        return
+    
+    # The duration of each entry is worked out from the start and end times,
+    # allowing for entries that wrap past midnight.
+    length  = self._minutes(entry.c.end_time) -\
+              self._minutes(entry.c.start_time)
+    length  = case([(length < 0, length + 1440)], else_=length)
+    columns = []
+    for group in groups:
+      columns += keys[group]
+    query   = select([c.label('c%d' % i) for i, (n, c) in enumerate(columns)] +
+                     [func.sum(length).label('minutes'),
+                      func.count(entry.c.id).label('entries')],
+                     from_obj=[entry\
+                      .outerjoin(dept, entry.c.department_id == dept.c.id)\
+                      .outerjoin(proj, entry.c.project_id == proj.c.id)\
+                      .outerjoin(task, entry.c.task_id == task.c.id)])\
+              .where(and_(entry.c.date >= start, entry.c.date <= end))\
+              .group_by(*[c for n, c in columns])\
+              .order_by(*[c for n, c in columns])
+    conn    = self.engine.connect()
+    rows    = [list(r[:len(columns)]) + [r['minutes'] / 60.0, r['entries']]
+               for r in conn.execute(query)]
+    conn.close()
+    
+    header  = [n for n, c in columns] + ['HOURS', 'ENTRIES']
+    if csvout:
+      import csv
+      writer = csv.writer(sys.stdout)
+      writer.writerow(header)
+      for row in rows:
+        writer.writerow([unicode(v).encode('utf-8') if v is not None else ''
+                         for v in row[:-2]] + ['%.2f' % row[-2], row[-1]])
+      return
+    
+    cells   = [[u'' if v is None else unicode(v) for v in row[:-2]] +
+               [u'%.2f' % row[-2], unicode(row[-1])] for row in rows]
+    cells.append([u'TOTAL'] + [u''] * (len(columns) - 1) +
+                 [u'%.2f' % sum([r[-2] for r in rows]),
+                  unicode(sum([r[-1] for r in rows]))])
+    widths  = [max([len(h)] + [len(c[i]) for c in cells]) 
+               for i, h in enumerate(header)]
+    print ' '.join(['%-*s' % (w, h) for w, h in zip(widths, header)])
+    print ' '.join(['-' * w for w in widths])
+    for idx, row in enumerate(cells):
+      if idx == len(cells) - 1:
+        print ' '.join(['-' * w for w in widths])
+      print ' '.join(['%-*s' % (w, c) for w, c in zip(widths, row)])
+  
   def do_quit(self, s):
     '''quit
     Quits Timecard.'''
     sys.exit()
   
+  def serve(self, path):
+    '''
+    serve(path)
+    Runs TimeCard as a daemon listening on the unix socket at path.  Every
+    connection sends a single command line and gets the output of that command
+    back, so the database engine, the catalogue cache, and the ATRWeb session
+    all stay warm between commands.  Commands that would normally prompt for
+    input can't do so here.  The quit command stops the daemon.
+    '''
+    import SocketServer
+    import StringIO
+    import signal
+    import socket
+    import traceback
+    
+    # If there is already a socket file there, we need to see if there is a
+    # daemon still behind it or if it was just left over.
+    if os.path.exists(path):
+      try:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe.connect(path)
+        probe.close()
+        print 'There is already a TimeCard daemon listening on %s' % path
+        return
+      except socket.error:
+        os.unlink(path)
+    
+    cli     = self
+    running = [True]
+    class Handler(SocketServer.StreamRequestHandler):
+      def handle(self):
+        line        = self.rfile.readline().strip()
+        output      = StringIO.StringIO()
+        stdin       = sys.stdin
+        stdout      = sys.stdout
+        sys.stdin   = StringIO.StringIO()
+        sys.stdout  = output
+        cli.stdout  = output
+        try:
+          try:
+            if line != '':
+              cli.onecmd(line)
+          except SystemExit:
+            running[0] = False
+          except EOFError:
+            print '\nThis command needs input and cannot be run by the daemon.'
+          except:
+            traceback.print_exc(file=output)
+        finally:
+          sys.stdin   = stdin
+          sys.stdout  = stdout
+          cli.stdout  = stdout
+        data = output.getvalue()
+        if isinstance(data, unicode):
+          data = data.encode('utf-8')
+        self.wfile.write(data)
+    
+    # The socket is created with only the owner able to use it.  Anyone else
+    # who could connect would be running commands with our ATRWeb session, so
+    # it can't be opened up even for the moment before a chmod.
+    umask   = os.umask(0077)
+    try:
+      server  = SocketServer.UnixStreamServer(path, Handler)
+    finally:
+      os.umask(umask)
+    
+    # The catalogue cache is loaded now, so that the first command doesn't
+    # have to wait for it.
+    self._catalogue()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+    print 'TimeCard daemon listening on %s' % path
+    try:
+      while running[0]:
+        server.handle_request()
+    finally:
+      server.server_close()
+      os.unlink(path)
+  
 if __name__ == '__main__':
-  if len(sys.argv) > 1:
-    TimeCardCLI().onecmd(' '.join(sys.argv[1:]))
-  else:
-    TimeCardCLI().cmdloop()
\ No newline at end of file
+  # Only the options in front of the command belong to timecard.py itself,
+  # anything after the command name is left for the command.
+  #  --daemon          Runs as a daemon (see TimeCardCLI.serve).
+  #  --stats           Prints the wall time, HTTP, parse, and SQL stats after
+  #                    every command.
+  #  --profile [FILE]  Writes a cProfile dump of the whole run to the file.
+  opts, args  = getopt.getopt(sys.argv[1:], '', 
+                              ['daemon', 'stats', 'profile='])
+  options     = dict(opts)
+  profile     = None
+  if '--profile' in options:
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+  try:
+    cli = TimeCardCLI(stats=Stats() if '--stats' in options else None)
+    if '--daemon' in options:
+      cli.serve(os.path.join(cli.path, 'timecard.sock'))
+    elif len(args) > 0:
+      cli.onecmd(' '.join(args))
+    else:
+      cli.cmdloop()
+  finally:
+    if profile is not None:
+      profile.disable()
+      profile.dump_stats(options['--profile'])
\ No newline at end of file